@@ -0,0 +1,319 @@
+"""
+Benchmark of the service at scale. Runs `main.main()` against a fake gateway, a simulated network
+and a synthetic DB seeded from `all_cameras.csv`, so no real cameras or broker are touched.
+
+Reports cycle completion time, event loop lag, publishes per second, peak RSS, DB write latency
+and RPC handling latency. With --baseline it exits with code 1 if any of them regressed.
+
+Usage:
+    python benchmark.py --cameras 10000 --period 30 --cycles 2 --save bench.json
+    python benchmark.py --cameras 50000 --loss 0.02 --outage 0.1 --baseline bench.json
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+from collections import Counter
+from time import monotonic, perf_counter
+
+import mmh3
+
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "all_cameras.csv")
+
+# Metrics where lower is better, checked against baseline.
+CHECKED_METRICS = (
+    "cycle_time",
+    "loop_lag_p99_ms",
+    "loop_lag_max_ms",
+    "publishes_per_sec",
+    "peak_rss_mb",
+    "db_write_max_ms",
+    "rpc_handle_p95_ms",
+    "rpc_apply_ms",
+)
+
+
+class FakeGateway:
+    """Stand-in for TBGatewayMqttClient, counts what would have been published."""
+
+    def __init__(self) -> None:
+        self.counts = Counter()
+        self.replies = {}
+        self._rpc_handler = None
+
+    def connect(self) -> None:
+        pass
+
+    def disconnect(self) -> None:
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    def gw_set_server_side_rpc_request_handler(self, handler) -> None:
+        self._rpc_handler = handler
+
+    def publish_data(self, data: dict, topic: str, qos: int) -> None:
+        self.counts["publishes"] += 1
+        self.counts["devices"] += len(data)
+
+    def gw_send_telemetry(self, device: str, telemetry, quality_of_service: int = 1) -> None:
+        self.publish_data({device: telemetry}, "v1/gateway/telemetry", quality_of_service)
+
+    def gw_connect_device(self, device_name: str, device_type: str = "default") -> None:
+        self.counts["connects"] += 1
+
+    def gw_disconnect_device(self, device_name: str) -> None:
+        self.counts["disconnects"] += 1
+
+    def gw_send_rpc_reply(self, device: str, req_id, resp, quality_of_service=None) -> None:
+        self.replies[req_id] = resp
+
+
+class SimulatedNetwork:
+    """Stand-in for IcmpProber of ProbeEngine. Answers echo requests with random latency and loss.
+    `outage` share of cameras doesn't answer at all.
+    """
+
+    is_open = True
+
+    def __init__(self, latency: float, jitter: float, loss: float, outage: float) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.outage = outage
+        self.echoes = 0
+        self.probed = set()
+        self.first_probe = None
+        self.all_probed = None
+        self.expected = 0
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    async def echo(self, ip: str, timeout: float) -> float | None:
+        self.echoes += 1
+        if self.first_probe is None:
+            self.first_probe = monotonic()
+        if ip not in self.probed:
+            self.probed.add(ip)
+            if len(self.probed) == self.expected:
+                self.all_probed = monotonic()
+
+        down = mmh3.hash(ip, signed=False) / 2**32 < self.outage
+        rtt = max(0.0, random.gauss(self.latency, self.jitter))
+        if down or random.random() < self.loss or rtt > timeout:
+            await asyncio.sleep(timeout)
+            return None
+        await asyncio.sleep(rtt)
+        return rtt
+
+
+def seed_db(cameras: int, period: int) -> None:
+    """Fill DB with `cameras` rows made from `all_cameras.csv`, with unique ids, names and IPs."""
+    from database import bulk_sync_cameras, db_init
+
+    with open(SOURCE, encoding="utf-8-sig") as f:
+        rows = list(csv.DictReader(f))
+
+    db_init()
+    inserts = []
+    for i in range(cameras):
+        row = rows[i % len(rows)]
+        copy = i // len(rows)
+        inserts.append(
+            {
+                "id": f"{row['UUID']}-{copy}" if copy else row["UUID"],
+                "name": f"{row['Название']} #{copy}" if copy else row["Название"],
+                "ip": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}",
+                "ping_period": period,
+            }
+        )
+    if not bulk_sync_cameras(inserts, [], []):
+        raise SystemExit("Failed to seed DB")
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+async def measure_loop_lag(lags: list[float], interval: float = 0.05) -> None:
+    """Measure how late the event loop wakes up a sleeping coroutine."""
+    while True:
+        started = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - started - interval)
+
+
+def rpc_storm(main, gateway: FakeGateway, count: int, period: int) -> list[float]:
+    """Send `update_ping_period` RPC's from a separate thread, like MQTT client does.
+
+    Returns:
+        list[float]: Handling time of every RPC.
+    """
+    durations = []
+    for record in list(main.registry)[:count]:
+        request = {
+            "device": record.name,
+            "data": {
+                "id": f"bench-{record.id}",
+                "method": "update_ping_period",
+                "params": {"seconds": period * 2},
+            },
+        }
+        started = perf_counter()
+        main.handle_rpc(gateway, request)
+        durations.append(perf_counter() - started)
+    return durations
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import main
+
+    gateway = FakeGateway()
+    network = SimulatedNetwork(args.latency, args.jitter, args.loss, args.outage)
+    network.expected = args.cameras
+    main.probes.prober = network
+
+    # Time every write of ping results to DB.
+    db_writes = []
+    write = main.store._write
+
+    def timed_write(rows):
+        started = perf_counter()
+        write(rows)
+        db_writes.append(perf_counter() - started)
+
+    main.store._write = timed_write
+
+    lags = []
+    lag_task = asyncio.create_task(measure_loop_lag(lags))
+    started = monotonic()
+    service = asyncio.create_task(main.main(gateway))
+
+    # Let the first cycle complete, then hit the service with an RPC storm.
+    deadline = started + args.cycles * args.period
+    while network.all_probed is None and monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    rpc_started = monotonic()
+    rpc_durations = await asyncio.to_thread(
+        rpc_storm, main, gateway, args.rpcs, args.period
+    )
+    while len(main.registry.by_period(args.period * 2)) < len(rpc_durations):
+        if monotonic() - rpc_started > args.period:
+            break
+        await asyncio.sleep(0.001)
+    rpc_apply = monotonic() - rpc_started
+
+    await asyncio.sleep(max(0.0, deadline - monotonic()))
+    await main.store.flush()
+    elapsed = monotonic() - started
+    service.cancel()
+    lag_task.cancel()
+    await asyncio.gather(service, lag_task, return_exceptions=True)
+
+    return {
+        "cameras": args.cameras,
+        "period": args.period,
+        "startup_time": round((network.first_probe or monotonic()) - started, 3),
+        # Time it took to ping every camera once. Whole run time if it never happened.
+        "cycle_time": round(
+            (network.all_probed or monotonic()) - (network.first_probe or started), 3
+        ),
+        "cameras_probed": len(network.probed),
+        # Pings that overlapped the next deadline of camera, and pings cancelled at their deadline.
+        "probes_skipped": int(sum(main.metrics.PROBES_SKIPPED._values.values())),
+        "probe_overruns": int(sum(main.metrics.PROBE_OVERRUNS._values.values())),
+        "echoes_per_sec": round(network.echoes / elapsed, 1),
+        "loop_lag_p99_ms": round(1000 * percentile(lags, 0.99), 2),
+        "loop_lag_max_ms": round(1000 * max(lags, default=0.0), 2),
+        "publishes_per_sec": round(gateway.counts["publishes"] / elapsed, 2),
+        "devices_per_publish": round(
+            gateway.counts["devices"] / max(1, gateway.counts["publishes"]), 1
+        ),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "db_writes": len(db_writes),
+        "db_write_max_ms": round(1000 * max(db_writes, default=0.0), 2),
+        "rpc_handle_p95_ms": round(1000 * percentile(rpc_durations, 0.95), 3),
+        "rpc_apply_ms": round(1000 * rpc_apply, 2),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Get metrics that are worse than baseline by more than `tolerance` share."""
+    regressions = []
+    for key in CHECKED_METRICS:
+        if key in baseline and result[key] > baseline[key] * (1 + tolerance) + 1e-3:
+            regressions.append(f"{key}: {baseline[key]} -> {result[key]}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the service at scale.")
+    parser.add_argument("--cameras", type=int, default=10000)
+    parser.add_argument("--period", type=int, default=30, help="Ping period, seconds.")
+    parser.add_argument("--cycles", type=int, default=2, help="Ping periods to run.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mean RTT, seconds.")
+    parser.add_argument("--jitter", type=float, default=0.005, help="RTT deviation, seconds.")
+    parser.add_argument("--loss", type=float, default=0.01, help="Share of lost echoes.")
+    parser.add_argument("--outage", type=float, default=0.05, help="Share of dead cameras.")
+    parser.add_argument("--rpcs", type=int, default=500, help="RPC's in the storm.")
+    parser.add_argument("--save", help="Save results to JSON file.")
+    parser.add_argument("--baseline", help="Fail if results regressed from this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    save = args.save and os.path.abspath(args.save)
+    baseline = args.baseline and os.path.abspath(args.baseline)
+
+    # Service reads settings on import, so everything has to be set up before main is imported.
+    workdir = tempfile.mkdtemp(prefix="cameras-bench-")
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.sqlite")
+    os.environ.setdefault("PROBE_BACKEND", "simulated")
+    # Simulated network lives in this process, so cameras are pinged here too.
+    os.environ["PROBE_WORKERS"] = "0"
+    os.environ.setdefault("STORE_FLUSH_INTERVAL", str(args.period / 2))
+    for key, value in (
+        ("CUBA_URL", "localhost"),
+        ("TB_GATEWAY_TOKEN", "benchmark"),
+        ("TB_TOTALS_DEVICE_NAME", "CAMERAS_TOTALS"),
+        ("TB_CLIENT_ID", "benchmark"),
+        ("TB_DEVICE_PROFILE", "default"),
+        ("PING_COUNT", "2"),
+        ("PING_INTERVAL", "1"),
+    ):
+        os.environ.setdefault(key, value)
+    os.chdir(workdir)
+
+    seed_db(args.cameras, args.period)
+    result = asyncio.run(run(args))
+    logging.shutdown()
+    print(json.dumps(result, indent=2))
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:", *regressions, sep="\n  ")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
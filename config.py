@@ -5,6 +5,8 @@ import logging
 import os
 from dotenv import load_dotenv
 
+from topology import parse_edges
+
 
 logging.basicConfig(filename="info.log", level=logging.INFO)
 
@@ -21,6 +23,112 @@ TB_DEVICE_PROFILE = os.environ["TB_DEVICE_PROFILE"]
 PING_COUNT = os.environ["PING_COUNT"]
 PING_INTERVAL = os.environ["PING_INTERVAL"]
 
+# Probe settings. "icmp" sends echo requests from the single in-process socket,
+# "subprocess" spawns system `ping` for every camera.
+PROBE_BACKEND = os.environ.get("PROBE_BACKEND", "icmp")
+PING_TIMEOUT = float(os.environ.get("PING_TIMEOUT", "2"))
+# First echo request waits for reply from PING_MIN_TIMEOUT to PING_TIMEOUT seconds,
+# depending on recent RTT of camera. The rest of PING_COUNT requests are sent only if it is lost.
+PING_MIN_TIMEOUT = float(os.environ.get("PING_MIN_TIMEOUT", "0.2"))
+
+# Probe of cameras without own setting: "icmp", "tcp[:port]" (connect to port, 554 by default)
+# or "rtsp[:port]" (RTSP OPTIONS request). Every backend has it's own reply timeout.
+DEFAULT_PROBE = os.environ.get("DEFAULT_PROBE", "icmp")
+TCP_PROBE_TIMEOUT = float(os.environ.get("TCP_PROBE_TIMEOUT", "2"))
+RTSP_PROBE_TIMEOUT = float(os.environ.get("RTSP_PROBE_TIMEOUT", "3"))
+PROBE_SETTINGS = {
+    "count": int(PING_COUNT),
+    "interval": float(PING_INTERVAL),
+    "min_timeout": PING_MIN_TIMEOUT,
+    "timeouts": {"icmp": PING_TIMEOUT, "tcp": TCP_PROBE_TIMEOUT, "rtsp": RTSP_PROBE_TIMEOUT},
+    "default_probe": DEFAULT_PROBE,
+}
+
+# Probe scheduling limits: probes running at the same time and probes started per second.
+PROBE_MAX_CONCURRENCY = int(os.environ.get("PROBE_MAX_CONCURRENCY", "1000"))
+PROBE_RATE = float(os.environ.get("PROBE_RATE", "500"))
+# Ping of camera has to finish within this share of it's ping period after it came due,
+# otherwise it is cancelled and camera is reported as timed out.
+PROBE_DEADLINE = float(os.environ.get("PROBE_DEADLINE", "0.9"))
+# After start cameras are pinged in order of their last ping, oldest first, spread over STARTUP_RAMP
+# seconds (one ping period of camera at most). Then every camera returns to it's phase offset.
+STARTUP_RAMP = float(os.environ.get("STARTUP_RAMP", "60"))
+
+# Cameras are pinged by PROBE_WORKERS processes, that share the limits above. Results are passed back
+# through shared memory of PROBE_WORKER_SLOTS cameras (twice as many as cameras at start by default).
+# 0 pings in the main process.
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS", "0"))
+PROBE_WORKER_SLOTS = int(os.environ.get("PROBE_WORKER_SLOTS", "0"))
+
+# Telemetry batching: devices in one gateway message and seconds telemetry may wait in batch.
+TELEMETRY_BATCH_SIZE = int(os.environ.get("TELEMETRY_BATCH_SIZE", "250"))
+TELEMETRY_FLUSH_INTERVAL = float(os.environ.get("TELEMETRY_FLUSH_INTERVAL", "5"))
+
+# Telemetry that can't be delivered (gateway is disconnected, or more than SPOOL_MAX_PENDING messages
+# wait for acknowledgement) is spooled to SPOOL_PATH, SPOOL_MAX_ROWS device rows at most.
+# It is replayed in messages of SPOOL_REPLAY_BATCH rows, SPOOL_REPLAY_RATE messages per second.
+SPOOL_PATH = os.environ.get("SPOOL_PATH", "spool.sqlite")
+SPOOL_MAX_ROWS = int(os.environ.get("SPOOL_MAX_ROWS", "1000000"))
+SPOOL_MAX_PENDING = int(os.environ.get("SPOOL_MAX_PENDING", "1000"))
+SPOOL_REPLAY_BATCH = int(os.environ.get("SPOOL_REPLAY_BATCH", "1000"))
+SPOOL_REPLAY_RATE = float(os.environ.get("SPOOL_REPLAY_RATE", "5"))
+
+# Report-by-exception: publish camera status only when it changes,
+# and resend it anyway every TELEMETRY_HEARTBEAT_CYCLES cycles.
+REPORT_BY_EXCEPTION = os.environ.get("REPORT_BY_EXCEPTION", "1") == "1"
+TELEMETRY_HEARTBEAT_CYCLES = int(os.environ.get("TELEMETRY_HEARTBEAT_CYCLES", "10"))
+
+# Status hysteresis: online camera goes offline after STATUS_DOWN_AFTER failed pings in a row,
+# offline camera goes online after STATUS_UP_AFTER successful ones. Camera is reported flapping
+# when it's last FLAP_WINDOW pings change between success and failure FLAP_TRANSITIONS times or more.
+STATUS_DOWN_AFTER = int(os.environ.get("STATUS_DOWN_AFTER", "2"))
+STATUS_UP_AFTER = int(os.environ.get("STATUS_UP_AFTER", "2"))
+FLAP_WINDOW = int(os.environ.get("FLAP_WINDOW", "20"))
+FLAP_TRANSITIONS = int(os.environ.get("FLAP_TRANSITIONS", "6"))
+
+# Ping results kept per camera for link metrics. With LINK_STATS_TELEMETRY enabled
+# RTT p50/p95, loss and jitter are sent after every ping, along with status if it is reported.
+LINK_STATS_SAMPLES = int(os.environ.get("LINK_STATS_SAMPLES", "32"))
+LINK_STATS_TELEMETRY = os.environ.get("LINK_STATS_TELEMETRY", "0") == "1"
+
+# Seconds between writes of buffered ping results (Camera.last_ping, Camera.online) to DB.
+STORE_FLUSH_INTERVAL = float(os.environ.get("STORE_FLUSH_INTERVAL", "30"))
+
+# Every ping result is appended to probe history in HISTORY_PATH directory every HISTORY_FLUSH_INTERVAL
+# seconds, it is kept for HISTORY_RETENTION_DAYS days. It is used for `get_uptime` RPC and `history.py` report.
+HISTORY_PATH = os.environ.get("HISTORY_PATH", "history")
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "10"))
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "90"))
+
+# RPC's arriving within RPC_BATCH_WINDOW seconds of each other are executed as one batch:
+# ping period updates of the batch are saved in one transaction and applied at once.
+RPC_BATCH_WINDOW = float(os.environ.get("RPC_BATCH_WINDOW", "0.05"))
+
+# Devices are connected to platform in batches with a pause (sec) between batches.
+DEVICE_CONNECT_BATCH = int(os.environ.get("DEVICE_CONNECT_BATCH", "100"))
+DEVICE_CONNECT_PAUSE = float(os.environ.get("DEVICE_CONNECT_PAUSE", "0.01"))
+
+# Edges to be pinged before cameras behind them, "edge=ip,edge=ip" (e.g. "krg=10.20.0.1,tem=10.30.0.1").
+# Edge of every camera is set from `edges.csv` via importer, or via RPC.
+EDGE_GATEWAYS = parse_edges(os.environ.get("EDGE_GATEWAYS", ""))
+EDGE_PROBE_PERIOD = float(os.environ.get("EDGE_PROBE_PERIOD", "10"))
+
+# Region DBs for supervisor mode, comma separated paths. Every `dbs/*.sqlite` by default.
+REGIONS = [path for path in os.environ.get("REGIONS", "").split(",") if path]
+
+# Runtime metrics are served in Prometheus text format on METRICS_HOST:METRICS_PORT (0 disables).
+# In supervisor mode every region worker serves it's own metrics, on ports starting from METRICS_PORT.
+# Every METRICS_TELEMETRY_INTERVAL seconds they are sent as telemetry of totals device (0 disables),
+# region workers send them to their own totals device, "TB_TOTALS_DEVICE_NAME <region>".
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_TELEMETRY_INTERVAL = float(os.environ.get("METRICS_TELEMETRY_INTERVAL", "0"))
+
+# Seconds between reports of changed online/offline totals (overall, by region, edge and group).
+# In supervisor mode every region worker reports totals of it's cameras to it's own totals devices,
+# and supervisor sends totals of all regions to TB_TOTALS_DEVICE_NAME and it's breakdown devices.
+TOTALS_INTERVAL = float(os.environ.get("TOTALS_INTERVAL", "10"))
+
 # Global variables.
-db_modified = False
-cameras_online = {}
+# Last status sent to platform and cycles passed since, by device name.
+cameras_reported = {}
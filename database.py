@@ -2,23 +2,70 @@
 Here is implemented database connection and all the DML interaction with Database.
 """
 
-from sqlalchemy import create_engine, select, update
+from sqlalchemy import create_engine, delete, event, insert, inspect, select, text, update
 from sqlalchemy.orm import Session
 from models import Base, Camera
+from metrics import DB_OPERATION_DURATION, timed
 from sqlite3 import IntegrityError
-from typing import Sequence
+from time import perf_counter
+from typing import Iterator, Sequence
 import logging
+import os
 
 
-engine = create_engine("sqlite:///db.sqlite")
+# WAL lets probe results be written while RPC handlers read, and busy timeout makes
+# concurrent writers wait for each other instead of failing.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+# Every region worker of supervisor gets it's own DB file.
+engine = create_engine(f"sqlite:///{os.environ.get('DB_PATH', 'db.sqlite')}")
 
 session = Session(engine, expire_on_commit=True, autoflush=False)
 
 
+def configure_connection(dbapi_connection, *args) -> None:
+    """Apply SQLITE_PRAGMAS to a new sqlite3 connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+event.listen(engine, "connect", configure_connection)
+
+
 def db_init():
     Base.metadata.create_all(engine)
+    migrate()
+
+
+def migrate() -> None:
+    """Add columns and indexes, that were introduced after DB was created, to existing tables."""
+    table = Camera.__table__
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+            if column.default is not None and column.default.is_scalar:
+                ddl += f" NOT NULL DEFAULT {column.default.arg!r}"
+            connection.execute(text(ddl))
+            logging.info(f"Added column {table.name}.{column.name}")
 
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
+
+@timed(DB_OPERATION_DURATION, operation="get_all_cameras")
 def get_all_cameras() -> Sequence:
     """Get all cameras in DB.
 
@@ -29,78 +76,102 @@ def get_all_cameras() -> Sequence:
         return session.scalars(select(Camera)).all()
 
 
-def get_unique_ping_periods() -> Sequence:
-    """Get unique values of Camera.ping_period.
-
-    Returns:
-        Sequence: List of Camera.ping_period.
-    """
-    with Session(engine, expire_on_commit=False) as session:
-        return session.scalars(select(Camera.ping_period)).unique().all()
-
-
-def get_cameras_by_ping_period(ping_period: int) -> Sequence:
-    """Get list of cameras with given ping_period.
+def iter_camera_rows(batch_size: int = 5000) -> Iterator:
+    """Stream columns of all cameras needed for CameraRecord in one query,
+    without building ORM objects.
 
     Args:
-        ping_period (int): ping period of camera.
+        batch_size (int, optional): Rows fetched at once. Defaults to 5000.
 
-    Returns:
-        Sequence: List of Cameras.
+    Yields:
+        Row: Camera columns, accessible as attributes.
     """
-    with Session(engine, expire_on_commit=False) as session:
-        return session.scalars(
-            select(Camera).where(Camera.ping_period == ping_period)
-        ).all()
+    started = perf_counter()
+    with engine.connect() as connection:
+        yield from connection.execution_options(yield_per=batch_size).execute(
+            select(
+                Camera.id,
+                Camera.name,
+                Camera.ip,
+                Camera.ping_period,
+                Camera.edge,
+                Camera.region,
+                Camera.group_name,
+                Camera.probe,
+                Camera.online,
+                Camera.flapping,
+                Camera.history,
+                Camera.reported,
+                Camera.rtt,
+                Camera.last_ping,
+            )
+        )
+    DB_OPERATION_DURATION.observe(perf_counter() - started, operation="iter_camera_rows")
 
 
-def get_modified_cameras() -> Sequence:
-    """Get all recently modified cameras (Camera is modified if Camera.status == 1).
+@timed(DB_OPERATION_DURATION, operation="update_ping_periods")
+def update_ping_periods(changes: list[tuple[str, int, int]]) -> bool:
+    """Set Camera.ping_period of many cameras in a single transaction.
+    Cameras are marked as modified (Camera.status = 1) until the change is applied.
+
+    Args:
+        changes (list[tuple[str, int, int]]): Camera.id, current and new ping period.
 
     Returns:
-        Sequence: List of Cameras.
+        bool: Returns True if successful. False otherwise.
     """
-    with Session(engine, expire_on_commit=False) as session:
-        return session.scalars(select(Camera).where(Camera.status == 1)).all()
+    try:
+        with Session(engine) as session:
+            session.execute(
+                update(Camera),
+                [
+                    {
+                        "id": camera_id,
+                        "prev_ping_period": ping_period,
+                        "ping_period": new_ping_period,
+                        "status": 1,
+                    }
+                    for camera_id, ping_period, new_ping_period in changes
+                ],
+            )
+            session.commit()
+            return True
+    except Exception as e:
+        logging.exception(f"Error while updating cameras ping periods: {e}")
+        return False
 
 
-def flush_cameras_changes(cameras: list[Camera]) -> None:
-    """Sets Camera.status = 0 for all given cameras.
+@timed(DB_OPERATION_DURATION, operation="clear_modified_status")
+def clear_modified_status(camera_ids: list[str]) -> None:
+    """Sets Camera.status = 0 for cameras with given ids.
 
     Args:
-        cameras (list[Camera]): List of Cameras.
+        camera_ids (list[str]): List of Camera.id.
     """
-    if cameras:
-        with Session(engine, expire_on_commit=False) as session:
-            session.add_all(cameras)
+    if camera_ids:
+        with Session(engine) as session:
+            session.execute(
+                update(Camera).where(Camera.id.in_(camera_ids)).values(status=0)
+            )
             session.commit()
 
 
-def update_ping_period(camera_name: str, new_ping_period: int) -> bool:
-    """Set Camera.ping_period for given camera on a given ping period.
-
-    Args:
-        camera_name (str): Camera.name
-        new_ping_period (int): New ping period to be set.add
+@timed(DB_OPERATION_DURATION, operation="clear_all_modified_status")
+def clear_all_modified_status() -> int:
+    """Sets Camera.status = 0 for all modified cameras.
 
     Returns:
-        bool: returns True if update was successful. False otherwise.
+        int: Amount of cameras that were modified.
     """
-    try:
-        with Session(engine, expire_on_commit=False) as session:
-            camera = session.scalar(select(Camera).where(Camera.name == camera_name))
-            camera.prev_ping_period = camera.ping_period
-            camera.ping_period = new_ping_period
-            camera.status = 1
-
-            session.add(camera)
-            session.commit()
-            return True
-    except Exception as e:
-        logging.exception(f"Error while updating camera: {e}")
-        return False
+    with Session(engine) as session:
+        result = session.execute(
+            update(Camera).where(Camera.status == 1).values(status=0)
+        )
+        session.commit()
+        return result.rowcount
 
 
+@timed(DB_OPERATION_DURATION, operation="create_camera")
 def create_camera(**kwargs) -> Camera | None:
     """Creates new camera. Returns new Camera from DB if cuccessful, None otherwise.
 
@@ -137,67 +208,79 @@ def get_camera_by_name(name: str) -> Camera | None:
         logging.exception(f"Error while fetching camera: {e}")
 
 
-def get_camera_by_id(id: str) -> Camera | None:
-    """
-    Fetch camera with given id if exists. Return None otherwise.
+
+
+
+
+
+
+@timed(DB_OPERATION_DURATION, operation="update_camera_by_id")
+def update_camera_by_id(camera_id: str, **values) -> bool:
+    """Update camera with given id.
 
     Args:
-        id (str): Camera.id.
+        camera_id (str): Camera.id.
+        **values: Columns to be set.
 
     Returns:
-        Camera | None: Either newly created Camera or None object.
+        bool: Returns True if successful. False otherwise.
     """
     try:
-        with Session(engine, expire_on_commit=False) as session:
-            return session.scalar(select(Camera).where(Camera.id == id))
+        with Session(engine) as session:
+            result = session.execute(
+                update(Camera).where(Camera.id == camera_id).values(**values)
+            )
+            session.commit()
+            return result.rowcount > 0
     except Exception as e:
-        logging.exception(f"Error while fetching camera: {e}")
+        logging.exception(f"Error while updating camera: {e}")
+        return False
 
 
-def update_camera(camera: Camera) -> bool:
-    """Update given camera.
+@timed(DB_OPERATION_DURATION, operation="delete_camera_by_id")
+def delete_camera_by_id(camera_id: str) -> bool:
+    """Delete camera with given id.
 
     Args:
-        camera (Camera): Camera object.
+        camera_id (str): Camera.id.
 
     Returns:
         bool: Returns True if successful. False otherwise.
     """
     try:
-        with Session(engine, expire_on_commit=False) as session:
-            session.add(camera)
+        with Session(engine) as session:
+            session.execute(delete(Camera).where(Camera.id == camera_id))
             session.commit()
             return True
     except Exception as e:
-        logging.exception(f"Error while updating camera: {e}")
+        logging.exception(f"Error while deleting camera: {e}")
         return False
 
 
-def delete_camera(camera: Camera) -> bool:
-    """Delete given camera.
+@timed(DB_OPERATION_DURATION, operation="bulk_sync_cameras")
+def bulk_sync_cameras(
+    inserts: list[dict], updates: list[dict], deletes: list[str]
+) -> bool:
+    """Insert, update and delete cameras in a single transaction.
 
     Args:
-        camera (Camera): Camera object
+        inserts (list[dict]): Columns of new cameras.
+        updates (list[dict]): Columns to be set, must contain Camera.id.
+        deletes (list[str]): Camera.id of cameras to be deleted.
 
     Returns:
         bool: Returns True if successful. False otherwise.
     """
     try:
-        with Session(engine, expire_on_commit=False) as session:
-            session.delete(camera)
+        with Session(engine) as session:
+            if inserts:
+                session.execute(insert(Camera), inserts)
+            if updates:
+                session.execute(update(Camera), updates)
+            for i in range(0, len(deletes), 500):
+                session.execute(delete(Camera).where(Camera.id.in_(deletes[i : i + 500])))
             session.commit()
             return True
     except Exception as e:
-        logging.exception(f"Error while deleting camera: {e}")
+        logging.exception(f"Error while syncing cameras: {e}")
         return False
-
-
-def update_ping_period_dev() -> None:
-    """Set Camera.ping_period for cameras.
-    Development use only.
-    """
-    with Session(engine, expire_on_commit=False) as session:
-        session.execute(
-            update(Camera).values({"ping_period": 60, "status": 0}).where(Camera.id)
-        )
-        session.commit()
@@ -0,0 +1,528 @@
+"""
+Here is implemented the probe history of cameras. Every ping result is appended to a columnar log
+of (camera slot, timestamp, status, RTT), one file per column, in daily (UTC) segments that are kept
+for a configured amount of days. Segments are read memory-mapped, and availability of cameras,
+edges and regions is computed over them with NumPy: uptime, count of outages and mean time to repair.
+
+Per-camera summary of every closed day is cached next to the segment, so queries over weeks only
+scan the days they cover partially.
+
+Usage:
+    python history.py --from 2024-05-01 --to 2024-06-01 --by region
+    DB_PATH=dbs/saran.sqlite python history.py --path history-saran --by camera --name "Camera 1"
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from time import time
+
+import numpy as np
+
+from registry import CameraRecord
+
+
+DAY = 86400
+COLUMNS = {"slot": "<u4", "ts": "<f8", "status": "i1", "rtt": "<f4"}
+# Closed days are summarized only after late results had time to be flushed.
+SUMMARY_DELAY = 3600
+# Reports cover this many seconds before their end by default.
+DEFAULT_RANGE = 30 * DAY
+# Fields availability can be broken down by, besides "camera" and "all".
+GROUPS = ("edge", "region", "group_name")
+
+
+def day_name(day: int) -> str:
+    """Get name of segment, e.g. "2024-05-01", by days since epoch."""
+    return datetime.fromtimestamp(day * DAY, timezone.utc).date().isoformat()
+
+
+def empty_summary(size: int) -> dict:
+    return {
+        "samples": np.zeros(size, np.int64),
+        "up": np.zeros(size, np.int64),
+        "first_ts": np.full(size, np.nan),
+        "first_status": np.full(size, -1, np.int8),
+        "last_status": np.full(size, -1, np.int8),
+        # Time camera recovered from outage it was in at the start, NaN if it didn't.
+        "lead_recovery": np.full(size, np.nan),
+        # Outages started and recovered from after the first result.
+        "started": np.zeros(size, np.int64),
+        "repairs": np.zeros(size, np.int64),
+        "repair_time": np.zeros(size),
+        # Start of outage camera is in at the end, NaN if it is up.
+        "trail_down": np.full(size, np.nan),
+    }
+
+
+def summarize(slot: np.ndarray, ts: np.ndarray, status: np.ndarray, size: int) -> dict:
+    """Summarize ping results per camera slot.
+
+    Args:
+        slot (np.ndarray): Camera slots of results.
+        ts (np.ndarray): Unix timestamps of results, ascending for every slot.
+        status (np.ndarray): 1 if camera was online, 0 otherwise.
+        size (int): Camera slots in summary, greater than any slot of results.
+
+    Returns:
+        dict: Arrays by slot, see `empty_summary`.
+    """
+    summary = empty_summary(size)
+    if not len(slot):
+        return summary
+
+    # Group results by slot, keeping order of time. Radix sort of 16 bit keys is much faster.
+    keys = slot.astype(np.uint16) if size <= 0xFFFF else slot
+    order = np.argsort(keys, kind="stable")
+    slot, ts, up = slot[order], ts[order], status[order] == 1
+
+    first = np.ones(len(slot), bool)
+    first[1:] = slot[1:] != slot[:-1]
+    last = np.ones(len(slot), bool)
+    last[:-1] = first[1:]
+    first_index = np.flatnonzero(first)
+    last_index = np.flatnonzero(last)
+
+    summary["samples"] = np.bincount(slot, minlength=size)
+    summary["up"] = np.bincount(slot[up], minlength=size)
+    summary["first_ts"][slot[first_index]] = ts[first_index]
+    summary["first_status"][slot[first_index]] = up[first_index]
+    summary["last_status"][slot[last_index]] = up[last_index]
+
+    # Outage starts with result down after result up of the same slot, or with the first result.
+    previous_up = np.empty(len(slot), bool)
+    previous_up[0] = False
+    previous_up[1:] = up[:-1]
+    down_starts = np.flatnonzero(~up & (first | previous_up))
+    recoveries = np.flatnonzero(up & ~first & ~previous_up)
+
+    # Starts and recoveries alternate within slot, so every recovery ends the latest start before it.
+    starts = down_starts[np.searchsorted(down_starts, recoveries) - 1]
+    leading = first[starts]
+    summary["lead_recovery"][slot[recoveries[leading]]] = ts[recoveries[leading]]
+    closed = recoveries[~leading]
+    summary["repairs"] = np.bincount(slot[closed], minlength=size)
+    summary["repair_time"] = np.bincount(
+        slot[closed], weights=ts[closed] - ts[starts[~leading]], minlength=size
+    )
+    started = down_starts[~first[down_starts]]
+    summary["started"] = np.bincount(slot[started], minlength=size)
+
+    trailing = last_index[~up[last_index]]
+    trail_starts = down_starts[np.searchsorted(down_starts, trailing, side="right") - 1]
+    summary["trail_down"][slot[trailing]] = ts[trail_starts]
+    return summary
+
+
+def combine(summaries: list[dict], size: int) -> dict:
+    """Chain summaries of consecutive periods, so outages continue across their borders.
+
+    Args:
+        summaries (list[dict]): Summaries in order of time.
+        size (int): Camera slots.
+
+    Returns:
+        dict: Arrays by slot: samples, up, outages, repairs and repair_time.
+    """
+    totals = {
+        name: np.zeros(size, np.int64) for name in ("samples", "up", "outages", "repairs")
+    }
+    totals["repair_time"] = np.zeros(size)
+    last_status = np.full(size, -1, np.int8)
+    down_since = np.full(size, np.nan)
+
+    for summary in summaries:
+        part = {}
+        for name, values in summary.items():
+            part[name] = np.resize(values, size)
+            if len(values) < size:
+                part[name][len(values):] = empty_summary(1)[name][0]
+        present = part["samples"] > 0
+        lead_down = present & (part["first_status"] == 0)
+        continued = lead_down & (last_status == 0)
+
+        totals["samples"] += part["samples"]
+        totals["up"] += part["up"]
+        totals["outages"] += part["started"] + (lead_down & ~continued)
+        totals["repairs"] += part["repairs"]
+        totals["repair_time"] += part["repair_time"]
+
+        # Outage camera was in at the start began in previous period, if camera was down at it's end.
+        recovered = lead_down & ~np.isnan(part["lead_recovery"])
+        start = np.where(continued, down_since, part["first_ts"])
+        totals["repairs"] += recovered
+        totals["repair_time"] += np.where(recovered, part["lead_recovery"] - start, 0)
+        # Or it recovered right at the first result.
+        recovered = present & (part["first_status"] == 1) & (last_status == 0)
+        totals["repairs"] += recovered
+        totals["repair_time"] += np.where(recovered, part["first_ts"] - down_since, 0)
+
+        still_down = lead_down & np.isnan(part["lead_recovery"])
+        down_since = np.where(
+            present,
+            np.where(continued & still_down, down_since, part["trail_down"]),
+            down_since,
+        )
+        last_status = np.where(present, part["last_status"], last_status)
+    return totals
+
+
+def availability(totals: dict, slots: np.ndarray | None = None) -> dict:
+    """Get availability of cameras, summed over slots.
+
+    Args:
+        totals (dict): Arrays by slot, see `combine`.
+        slots (np.ndarray | None, optional): Slots of cameras. Defaults to all slots.
+
+    Returns:
+        dict: Uptime %, count of outages, mean time to repair in seconds and cameras with results.
+            Count of results and repairs are included, so reports can be merged, see `merge_reports`.
+    """
+    if slots is not None:
+        totals = {name: values[slots] for name, values in totals.items()}
+    samples = int(totals["samples"].sum())
+    repairs = int(totals["repairs"].sum())
+    return {
+        "uptime": round(100 * int(totals["up"].sum()) / samples, 3) if samples else None,
+        "outages": int(totals["outages"].sum()),
+        "mttr": round(float(totals["repair_time"].sum()) / repairs, 1) if repairs else None,
+        "cameras": int((totals["samples"] > 0).sum()),
+        "samples": samples,
+        "repairs": repairs,
+    }
+
+
+def merge_reports(reports: list[dict]) -> dict:
+    """Merge availability reports of separate cameras, e.g. of region workers of supervisor.
+    Uptime and mean time to repair of the same key are weighted by results and repairs.
+
+    Args:
+        reports (list[dict]): Reports, see `ProbeHistory.report`.
+
+    Returns:
+        dict: Availability by camera name or group value.
+    """
+    merged = {}
+    for report in reports:
+        for key, values in report.items():
+            current = merged.get(key)
+            if current is None:
+                merged[key] = dict(values)
+                continue
+
+            samples = current["samples"] + values["samples"]
+            repairs = current["repairs"] + values["repairs"]
+            up = sum(part["uptime"] * part["samples"] for part in (current, values) if part["samples"])
+            repair_time = sum(
+                part["mttr"] * part["repairs"] for part in (current, values) if part["repairs"]
+            )
+            merged[key] = {
+                "uptime": round(up / samples, 3) if samples else None,
+                "outages": current["outages"] + values["outages"],
+                "mttr": round(repair_time / repairs, 1) if repairs else None,
+                "cameras": current["cameras"] + values["cameras"],
+                "samples": samples,
+                "repairs": repairs,
+            }
+    return dict(sorted(merged.items()))
+
+
+class ProbeHistory:
+    """Append-only columnar log of ping results in daily segments. Rows of one segment are matched
+    across column files by position, so segments are written by one process only, see `open`.
+    """
+
+    def __init__(self, path: str, retention_days: int) -> None:
+        """
+        Args:
+            path (str): Directory of segments.
+            retention_days (int): Days segments are kept.
+        """
+        self.path = path
+        self.retention_days = retention_days
+        os.makedirs(path, exist_ok=True)
+        self._slots_path = os.path.join(path, "slots.json")
+        self._slots = {}
+        if os.path.exists(self._slots_path):
+            with open(self._slots_path) as f:
+                self._slots = json.load(f)
+        self._slots_changed = False
+        self._pending = {name: [] for name in COLUMNS}
+        # Results are buffered by the event loop and flushed in worker thread.
+        self._pending_lock = threading.Lock()
+        self._expired_day = None
+        self._lock = None
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def slot(self, camera_id: str) -> int:
+        """Get slot of camera. Slots are never reused, so history of removed cameras stays readable."""
+        slot = self._slots.get(camera_id)
+        if slot is None:
+            slot = self._slots[camera_id] = len(self._slots)
+            self._slots_changed = True
+        return slot
+
+    def append(self, camera_id: str, ts: float, status: int, rtt: float | None) -> None:
+        """Buffer ping result of camera, it is written on next flush.
+
+        Args:
+            camera_id (str): Camera.id.
+            ts (float): Time of ping, Unix timestamp.
+            status (int): Camera connection status.
+            rtt (float | None): RTT in seconds, None if ping was lost.
+        """
+        with self._pending_lock:
+            pending = self._pending
+            pending["slot"].append(self.slot(camera_id))
+            pending["ts"].append(ts)
+            pending["status"].append(status)
+            pending["rtt"].append(np.nan if rtt is None else rtt)
+
+    def open(self) -> None:
+        """Take exclusive lock of directory for writing. Readers don't need it.
+
+        Raises:
+            RuntimeError: If directory is written by another process.
+        """
+        if self._lock is not None:
+            return
+        lock = open(os.path.join(self.path, "lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise RuntimeError(f"Probe history {self.path} is written by another process")
+        self._lock = lock
+
+    def _file(self, day: int, column: str) -> str:
+        return os.path.join(self.path, f"{day_name(day)}.{column}")
+
+    def flush(self) -> int:
+        """Append buffered results to segments of their days and drop expired segments.
+
+        Returns:
+            int: Results written.
+        """
+        self.open()
+        with self._pending_lock:
+            slots = dict(self._slots) if self._slots_changed else None
+            self._slots_changed = False
+            pending, self._pending = self._pending, {name: [] for name in COLUMNS}
+
+        if slots is not None:
+            with open(self._slots_path + ".tmp", "w") as f:
+                json.dump(slots, f)
+            os.replace(self._slots_path + ".tmp", self._slots_path)
+        rows = len(pending["ts"])
+        if rows:
+            columns = {
+                name: np.array(values, dtype=COLUMNS[name]) for name, values in pending.items()
+            }
+            days = (columns["ts"] // DAY).astype(np.int64)
+            for day in np.unique(days):
+                selected = days == day
+                # Slot column is written last, readers take rows present in every column.
+                for name in ("ts", "status", "rtt", "slot"):
+                    with open(self._file(int(day), name), "ab") as f:
+                        f.write(columns[name][selected].tobytes())
+
+        today = int(time() // DAY)
+        if self._expired_day != today:
+            self._expired_day = today
+            self.expire(today - self.retention_days)
+        return rows
+
+    def expire(self, before: int) -> None:
+        """Delete segments of days before `before` (days since epoch)."""
+        oldest = day_name(before)
+        for name in os.listdir(self.path):
+            if name[:10] < oldest and name[:4].isdigit():
+                os.remove(os.path.join(self.path, name))
+                logging.info(f"Removed expired probe history {name}")
+
+    def days(self) -> list[int]:
+        """Get days (since epoch) there are segments of."""
+        days = set()
+        for name in os.listdir(self.path):
+            if name.endswith(".slot"):
+                date = datetime.fromisoformat(name[:10]).replace(tzinfo=timezone.utc)
+                days.add(int(date.timestamp() // DAY))
+        return sorted(days)
+
+    def read(self, day: int) -> dict:
+        """Get columns of segment, memory-mapped."""
+        columns = {}
+        for name, dtype in COLUMNS.items():
+            path = self._file(day, name)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            columns[name] = (
+                np.memmap(path, dtype=dtype, mode="r") if size >= np.dtype(dtype).itemsize
+                else np.empty(0, dtype)
+            )
+        rows = min(len(values) for values in columns.values())
+        return {name: values[:rows] for name, values in columns.items()}
+
+    def summary(self, day: int, start: float | None = None, end: float | None = None) -> dict:
+        """Summarize results of day, within [start, end) if given. Summary of whole closed day is cached.
+
+        Args:
+            day (int): Days since epoch.
+            start (float | None, optional): Unix timestamp. Defaults to start of day.
+            end (float | None, optional): Unix timestamp. Defaults to end of day.
+
+        Returns:
+            dict: Arrays by slot, see `empty_summary`.
+        """
+        whole = (start is None or start <= day * DAY) and (end is None or end >= (day + 1) * DAY)
+        cached = self._file(day, "summary.npz")
+        closed = (day + 1) * DAY + SUMMARY_DELAY < time()
+        if whole and os.path.exists(cached):
+            with np.load(cached) as summary:
+                return dict(summary)
+
+        columns = self.read(day)
+        slot, ts, status = columns["slot"], columns["ts"], columns["status"]
+        if not whole:
+            selected = np.ones(len(ts), bool)
+            if start is not None:
+                selected &= ts >= start
+            if end is not None:
+                selected &= ts < end
+            slot, ts, status = slot[selected], ts[selected], status[selected]
+        summary = summarize(
+            np.asarray(slot), np.asarray(ts), np.asarray(status), len(self._slots)
+        )
+
+        if whole and closed:
+            # Summary may be read, or written by another thread or report of `history.py`,
+            # while it is written, so it is written to a file of it's own and replaces cache at once.
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, **summary)
+                os.replace(tmp, cached)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        return summary
+
+    def summarize_closed(self) -> None:
+        """Cache summaries of closed days that have none yet, so queries don't have to."""
+        for day in self.days():
+            closed = (day + 1) * DAY + SUMMARY_DELAY < time()
+            if closed and not os.path.exists(self._file(day, "summary.npz")):
+                self.summary(day)
+
+    async def run(self, interval: float) -> None:
+        """Flush results every `interval` seconds and summarize closed days, both in worker thread.
+        Works in loop.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+                await asyncio.to_thread(self.summarize_closed)
+            except Exception as e:
+                logging.exception(f"Error while writing probe history: {e}")
+
+    def query(self, start: float, end: float) -> dict:
+        """Get results of every camera slot within [start, end).
+
+        Args:
+            start (float): Unix timestamp.
+            end (float): Unix timestamp.
+
+        Returns:
+            dict: Arrays by slot: samples, up, outages, repairs and repair_time.
+        """
+        first, last = int(start // DAY), int((end - 1e-6) // DAY)
+        days = [day for day in self.days() if first <= day <= last]
+        summaries = [self.summary(day, start, end) for day in days]
+        return combine(summaries, len(self._slots))
+
+    def report(
+        self,
+        records: list[CameraRecord],
+        start: float,
+        end: float,
+        by: str = "camera",
+        name: str | None = None,
+    ) -> dict:
+        """Get availability of cameras within [start, end), by camera, edge, region, group or all of them.
+
+        Args:
+            records (list[CameraRecord]): Cameras.
+            start (float): Unix timestamp.
+            end (float): Unix timestamp.
+            by (str, optional): "camera", "all" or one of GROUPS. Defaults to "camera".
+            name (str | None, optional): Report only this camera name or group value. Defaults to None.
+
+        Returns:
+            dict: Availability (see `availability`) by camera name or group value.
+        """
+        if by not in ("camera", "all") + GROUPS:
+            raise ValueError(f"Unknown availability breakdown '{by}'")
+
+        totals = self.query(start, end)
+        groups = {}
+        for record in records:
+            slot = self._slots.get(record.id)
+            if slot is None:
+                continue
+            key = "all" if by == "all" else record.name if by == "camera" else getattr(record, by)
+            if key is not None and (name is None or key == name):
+                groups.setdefault(key, []).append(slot)
+        return {
+            key: availability(totals, np.array(slots)) for key, slots in sorted(groups.items())
+        }
+
+
+def parse_time(value: str) -> float:
+    """Get Unix timestamp of ISO date or time, UTC if timezone is not given."""
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def main() -> None:
+    import config
+    from database import db_init, get_all_cameras
+
+    parser = argparse.ArgumentParser(description="Report availability of cameras.")
+    parser.add_argument("--path", default=config.HISTORY_PATH, help="Probe history directory.")
+    parser.add_argument(
+        "--from", dest="start", help="Start date or time, UTC. Defaults to 30 days before end."
+    )
+    parser.add_argument("--to", dest="end", help="End date or time, UTC. Defaults to now.")
+    parser.add_argument(
+        "--by", default="region", choices=("camera", "all") + GROUPS, help="Breakdown."
+    )
+    parser.add_argument("--name", help="Only this camera name or group value.")
+    args = parser.parse_args()
+
+    end = parse_time(args.end) if args.end else time()
+    start = parse_time(args.start) if args.start else end - DEFAULT_RANGE
+    db_init()
+    records = [CameraRecord.from_model(camera) for camera in get_all_cameras()]
+    report = ProbeHistory(args.path, config.HISTORY_RETENTION_DAYS).report(
+        records, start, end, args.by, args.name
+    )
+
+    print(f"{args.by:<40} {'uptime %':>9} {'outages':>8} {'MTTR, s':>9} {'cameras':>8}")
+    for key, values in report.items():
+        uptime = "-" if values["uptime"] is None else f"{values['uptime']:.3f}"
+        mttr = "-" if values["mttr"] is None else f"{values['mttr']:.0f}"
+        print(f"{key:<40} {uptime:>9} {values['outages']:>8} {mttr:>9} {values['cameras']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Here is implemented the camera status state machine. Raw ping results are filtered with hysteresis,
+so a camera changes status only after several consistent results, and cameras that keep flipping
+within a sliding window are reported as flapping instead.
+
+State of every camera is kept in flat arrays, same as link metrics, and its history is packed into
+one integer, so it is cheap to persist.
+"""
+
+from array import array
+
+
+UNKNOWN = -1
+
+
+class StatusFilter:
+    """Hysteresis and flap detection over ping results, by Camera.id."""
+
+    def __init__(
+        self, down_after: int, up_after: int, window: int, flap_transitions: int
+    ) -> None:
+        """
+        Args:
+            down_after (int): Consecutive failed pings, after which online camera goes offline.
+            up_after (int): Consecutive successful pings, after which offline camera goes online.
+            window (int): Last ping results flapping is detected in, 62 at most,
+                so packed history fits in SQLite integer.
+            flap_transitions (int): Changes between success and failure within window, from which
+                camera is flapping. It stops flapping when there are less than half as many.
+        """
+        self.down_after = down_after
+        self.up_after = up_after
+        self.window = min(window, 62)
+        self.flap_transitions = flap_transitions
+        self._slots = {}
+        self._free = []
+        self._status = array("b")
+        self._flapping = array("B")
+        self._streak = array("H")
+        # Last results as bits, newest is the lowest, above them is a sentinel bit.
+        self._history = array("Q")
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _slot(self, camera_id: str) -> int:
+        slot = self._slots.get(camera_id)
+        if slot is not None:
+            return slot
+
+        if self._free:
+            slot = self._free.pop()
+            self._status[slot] = UNKNOWN
+            self._flapping[slot] = 0
+            self._streak[slot] = 0
+            self._history[slot] = 1
+        else:
+            slot = len(self._status)
+            self._status.append(UNKNOWN)
+            self._flapping.append(0)
+            self._streak.append(0)
+            self._history.append(1)
+        self._slots[camera_id] = slot
+        return slot
+
+    def update(self, camera_id: str, up: bool) -> tuple[int, bool]:
+        """Feed ping result of camera.
+
+        Args:
+            camera_id (str): Camera.id.
+            up (bool): Whether camera answered.
+
+        Returns:
+            tuple[int, bool]: Filtered status of camera and whether it is flapping.
+        """
+        slot = self._slot(camera_id)
+
+        # Shift result in history, keeping sentinel bit above the window.
+        history = self._history[slot]
+        length = min(history.bit_length(), self.window)
+        mask = (1 << length) - 1
+        self._history[slot] = history = (((history << 1) | up) & mask) | (1 << length)
+
+        # Hysteresis: status changes after enough consecutive results against it.
+        status = self._status[slot]
+        if status == UNKNOWN:
+            status, streak = int(up), 0
+        elif up != status:
+            streak = self._streak[slot] + 1
+            if streak >= (self.up_after if up else self.down_after):
+                status, streak = int(up), 0
+        else:
+            streak = 0
+        self._status[slot] = status
+        self._streak[slot] = min(streak, 0xFFFF)
+
+        # Flapping: count changes between neighbour results in window.
+        results = history & mask
+        transitions = bin((results ^ (results >> 1)) & (mask >> 1)).count("1")
+        if self._flapping[slot]:
+            self._flapping[slot] = transitions * 2 >= self.flap_transitions
+        else:
+            self._flapping[slot] = transitions >= self.flap_transitions
+
+        return status, bool(self._flapping[slot])
+
+    def status(self, camera_id: str) -> tuple[int, bool]:
+        """Get filtered status of camera and whether it is flapping. Status is UNKNOWN before first ping."""
+        slot = self._slots.get(camera_id)
+        if slot is None:
+            return UNKNOWN, False
+        return self._status[slot], bool(self._flapping[slot])
+
+    def history(self, camera_id: str) -> int:
+        """Get packed ping history of camera, to be persisted."""
+        slot = self._slots.get(camera_id)
+        return self._history[slot] if slot is not None else 1
+
+    def restore(self, camera_id: str, status: int, flapping: bool, history: int) -> None:
+        """Set persisted state of camera. Cameras without history are left unknown.
+
+        Args:
+            camera_id (str): Camera.id.
+            status (int): Filtered status.
+            flapping (bool): Whether camera was flapping.
+            history (int): Packed ping history.
+        """
+        if not history or history == 1:
+            return
+        slot = self._slot(camera_id)
+        length = min(history.bit_length() - 1, self.window)
+        results = history & ((1 << length) - 1)
+        self._history[slot] = results | (1 << length)
+        self._status[slot] = status
+        self._flapping[slot] = int(flapping)
+
+        # Recent results against status are the streak.
+        streak = 0
+        while streak < length and (results >> streak) & 1 != status:
+            streak += 1
+        self._streak[slot] = streak
+
+    def remove(self, camera_id: str) -> None:
+        slot = self._slots.pop(camera_id, None)
+        if slot is not None:
+            self._free.append(slot)
@@ -0,0 +1,57 @@
+"""
+Command line importer of cameras. Reads cameras from CSV (`list.csv`, `all_cameras.csv` or `edges.csv`
+format) or JSON and reconciles them with DB in a single transaction.
+
+Changes are picked up by running service on restart. Use `sync_devices` RPC to apply them live.
+
+Usage:
+    python importer.py list.csv [--sync] [--dry-run]
+    python importer.py edges.csv --fields edge
+    python importer.py list.csv --fields region,group_name
+    DB_PATH=dbs/saran.sqlite python importer.py saran.json
+"""
+
+import argparse
+import logging
+
+from database import db_init, get_all_cameras
+from provisioning import apply_changes, diff_cameras, read_rows
+from registry import CameraRegistry
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import cameras into DB.")
+    parser.add_argument("path", help="CSV or JSON file with cameras.")
+    parser.add_argument(
+        "--sync", action="store_true", help="Delete cameras that are not in the file."
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only print what would be changed."
+    )
+    parser.add_argument(
+        "--fields", help="Comma separated fields to take from the file, e.g. 'edge'."
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db_init()
+
+    # Load current cameras in one query and compare with file.
+    registry = CameraRegistry()
+    registry.load(get_all_cameras())
+    changes = diff_cameras(
+        read_rows(args.path),
+        registry,
+        delete_missing=args.sync,
+        fields=args.fields.split(",") if args.fields else None,
+    )
+    print(changes.summary())
+
+    if changes and not args.dry_run:
+        if not apply_changes(changes):
+            raise SystemExit("Import failed, see log for details.")
+        print("Changes saved.")
+
+
+if __name__ == "__main__":
+    main()
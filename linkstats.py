@@ -0,0 +1,113 @@
+"""
+Here are implemented per-camera link metrics. The last N ping results of every camera are kept
+in fixed-size ring buffers, backed by one flat array, so memory stays bounded with any amount of cameras.
+"""
+
+import math
+from array import array
+
+
+class LinkStats:
+    """Ring buffers of RTT samples by IP. Lost ping is stored as NaN."""
+
+    def __init__(self, samples: int) -> None:
+        """
+        Args:
+            samples (int): Samples kept per IP.
+        """
+        self.samples = samples
+        self._slots = {}
+        self._free = []
+        self._rtt = array("d")
+        self._position = array("I")
+        self._count = array("I")
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _slot(self, ip: str) -> int:
+        slot = self._slots.get(ip)
+        if slot is not None:
+            return slot
+
+        # Reuse slot of removed IP, or grow arrays by one ring.
+        if self._free:
+            slot = self._free.pop()
+            self._position[slot] = 0
+            self._count[slot] = 0
+        else:
+            slot = len(self._position)
+            self._rtt.extend([math.nan] * self.samples)
+            self._position.append(0)
+            self._count.append(0)
+        self._slots[ip] = slot
+        return slot
+
+    def record(self, ip: str, rtt: float | None) -> None:
+        """Add ping result.
+
+        Args:
+            ip (str): Camera IP.
+            rtt (float | None): RTT in seconds, None if ping was lost.
+        """
+        slot = self._slot(ip)
+        position = self._position[slot]
+        self._rtt[slot * self.samples + position] = math.nan if rtt is None else rtt
+        self._position[slot] = (position + 1) % self.samples
+        self._count[slot] = min(self._count[slot] + 1, self.samples)
+
+    def remove(self, ip: str) -> None:
+        slot = self._slots.pop(ip, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def last(self, ip: str) -> float | None:
+        """Get the latest RTT of IP, None if it was lost or there are no samples."""
+        slot = self._slots.get(ip)
+        if slot is None or not self._count[slot]:
+            return None
+        rtt = self._rtt[slot * self.samples + (self._position[slot] - 1) % self.samples]
+        return None if math.isnan(rtt) else rtt
+
+    def history(self, ip: str) -> list[float]:
+        """Get samples of IP from oldest to newest."""
+        slot = self._slots.get(ip)
+        if slot is None:
+            return []
+        start, count = slot * self.samples, self._count[slot]
+        oldest = (self._position[slot] - count) % self.samples
+        return [
+            self._rtt[start + (oldest + i) % self.samples] for i in range(count)
+        ]
+
+    def summary(self, ip: str) -> dict:
+        """Get RTT percentiles, loss and jitter of IP.
+
+        Args:
+            ip (str): Camera IP.
+
+        Returns:
+            dict: "rtt_p50", "rtt_p95", "jitter" in milliseconds and "loss" in percent.
+                Empty if there are no samples. RTT keys are omitted if every ping was lost.
+        """
+        history = self.history(ip)
+        if not history:
+            return {}
+
+        answered = [rtt for rtt in history if not math.isnan(rtt)]
+        summary = {"loss": round(100 * (1 - len(answered) / len(history)), 1)}
+        if answered:
+            ordered = sorted(answered)
+            summary["rtt_p50"] = round(1000 * ordered[(len(ordered) - 1) // 2], 2)
+            summary["rtt_p95"] = round(
+                1000 * ordered[math.ceil(0.95 * len(ordered)) - 1], 2
+            )
+            # Mean difference between consecutive RTTs.
+            if len(answered) > 1:
+                summary["jitter"] = round(
+                    1000
+                    * sum(abs(b - a) for a, b in zip(answered, answered[1:]))
+                    / (len(answered) - 1),
+                    2,
+                )
+        return summary
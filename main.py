@@ -4,84 +4,277 @@ This module is the entry point of the programm. It checks which camera from the
 
 import asyncio
 import logging
-from time import time
-from datetime import datetime, timedelta
+import multiprocessing
+from dataclasses import replace
+from time import monotonic, perf_counter, time
+from datetime import datetime
 
 from tb_gateway_mqtt import TBGatewayMqttClient
 
 import config
+import metrics
+from probe import ProbeEngine, parse_probe
+from probepool import TIMED_OUT, UNREACHABLE, ProbePool
+from scheduler import DeadlineScheduler, ProbeLimiter
+from telemetry import (
+    TelemetryAggregator,
+    pending_publishes,
+    restore_reported,
+    should_report,
+)
+from spool import TelemetrySpool
+from registry import CameraRecord, CameraRegistry
+from topology import EdgeMonitor
+from totals import StatusTotals
+from linkstats import LinkStats
+from hysteresis import UNKNOWN, StatusFilter
+from history import DEFAULT_RANGE, ProbeHistory
+from store import ResultStore
+from provisioning import (
+    DEFAULT_PING_PERIOD,
+    CameraChanges,
+    apply_changes,
+    diff_cameras,
+    normalize_row,
+    parse_ping_period,
+)
 
 from database import (
-    get_all_cameras,
+    engine,
+    iter_camera_rows,
     db_init,
-    get_unique_ping_periods,
-    get_cameras_by_ping_period,
-    get_modified_cameras,
-    flush_cameras_changes,
-    update_ping_period,
+    clear_all_modified_status,
+    clear_modified_status,
+    update_ping_periods,
     create_camera,
-    get_camera_by_name,
-    delete_camera,
-    update_camera,
+    delete_camera_by_id,
+    update_camera_by_id,
 )
 
 
 db_init()
-cameras_map = {}
-coroutines_map = {}
+registry = CameraRegistry()
+scheduler = DeadlineScheduler()
+# Probes in flight by Camera.id.
+probe_tasks = {}
+camera_events = asyncio.Queue()
+# RPC requests handed over from MQTT thread, with time they were received.
+rpc_requests = asyncio.Queue()
+# Held while registry is changed, and while RPC's read it in worker thread.
+registry_lock = asyncio.Lock()
+event_loop = None
+probes = ProbeEngine(**config.PROBE_SETTINGS)
+# Worker processes that ping cameras instead of main process, if configured. Region workers
+# of supervisor are daemonic, they can't have children, so they ping cameras themselves.
+probe_pool = (
+    ProbePool(config.PROBE_WORKERS)
+    if config.PROBE_WORKERS and not multiprocessing.current_process().daemon
+    else None
+)
+link_stats = LinkStats(config.LINK_STATS_SAMPLES)
+status_filter = StatusFilter(
+    config.STATUS_DOWN_AFTER,
+    config.STATUS_UP_AFTER,
+    config.FLAP_WINDOW,
+    config.FLAP_TRANSITIONS,
+)
+limiter = ProbeLimiter(config.PROBE_MAX_CONCURRENCY, config.PROBE_RATE)
+aggregator = TelemetryAggregator(
+    config.TELEMETRY_BATCH_SIZE,
+    config.TELEMETRY_FLUSH_INTERVAL,
+    TelemetrySpool(config.SPOOL_PATH, config.SPOOL_MAX_ROWS, config.SPOOL_REPLAY_BATCH),
+    config.SPOOL_MAX_PENDING,
+)
+store = ResultStore(engine.url.database, config.STORE_FLUSH_INTERVAL)
+edge_monitor = EdgeMonitor(config.EDGE_GATEWAYS, config.EDGE_PROBE_PERIOD)
+totals = StatusTotals()
+history = ProbeHistory(config.HISTORY_PATH, config.HISTORY_RETENTION_DAYS)
+# Device overall totals and metrics are sent to. Every region worker of supervisor has it's own.
+totals_device = config.TB_TOTALS_DEVICE_NAME
+# Connected devices of totals by region, edge and group.
+totals_devices = set()
+
+
+# RPC methods handled by the service. Others are counted in metrics as "other",
+# so requests from platform can't add labels without bound.
+RPC_METHODS = (
+    "add_device",
+    "delete_device",
+    "update_device",
+    "update_ping_period",
+    "get_uptime",
+    "add_devices",
+    "sync_devices",
+)
+
+
+def push_camera_event(action: str, *args) -> None:
+    """Hand cameras registry change over to the event loop. Safe to call from MQTT thread.
+
+    Args:
+        action (str): "add" with CameraRecord, or "remove" with Camera.id.
+    """
+    event_loop.call_soon_threadsafe(camera_events.put_nowait, (action, *args))
 
 
 def handle_rpc(gateway: TBGatewayMqttClient, request_body: dict) -> None:
-    """Callback for handling all RPC's from platform.
+    """Callback for handling all RPC's from platform. It is called from MQTT thread,
+    so request is only handed over to the event loop, see `process_rpc_requests`.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway to send RPC replies to.
         request_body (dict): Request body.
     """
-
     logging.info(f"RPC: {request_body}")
+    event_loop.call_soon_threadsafe(
+        rpc_requests.put_nowait, (request_body, perf_counter())
+    )
 
-    # Parse data from the RPC message
-    data = request_body["data"]
-    method = data["method"]
-    device = request_body["device"]
-    request_id = str(data["id"])
 
-    # Handle RPC according to method name
-    if method == "update_ping_period":
+async def process_rpc_requests(gateway: TBGatewayMqttClient) -> None:
+    """Execute RPC's handed over from MQTT thread, in order of arrival. Requests that arrive
+    within RPC_BATCH_WINDOW of each other are coalesced: consecutive ping period updates are saved
+    in one transaction, applied in one registry update and replied to together. Other methods are
+    executed one by one in worker thread, so neither MQTT thread nor event loop waits for DB.
+
+    Args:
+        gateway (TBGatewayMqttClient): Gateway to send RPC replies to.
+    """
+    while True:
+        # Wait for request, then take every request of the burst.
+        requests = [await rpc_requests.get()]
+        await asyncio.sleep(config.RPC_BATCH_WINDOW)
+        while not rpc_requests.empty():
+            requests.append(rpc_requests.get_nowait())
+
+        batch = []
+        for request_body, received in requests:
+            try:
+                data = request_body["data"]
+                method = data["method"]
+            except (KeyError, TypeError):
+                logging.warning(f"Malformed RPC is ignored: {request_body}")
+                continue
+            if method == "update_ping_period":
+                batch.append((request_body, received))
+                continue
+
+            await update_ping_periods_batch(gateway, batch)
+            batch = []
+            try:
+                async with registry_lock:
+                    await asyncio.to_thread(execute_rpc, gateway, request_body, data, method)
+            except Exception as e:
+                logging.exception(f"Error while executing RPC: {e}")
+            metrics.RPC_DURATION.observe(
+                perf_counter() - received, method=method if method in RPC_METHODS else "other"
+            )
+        await update_ping_periods_batch(gateway, batch)
+
+
+async def update_ping_periods_batch(
+    gateway: TBGatewayMqttClient, requests: list[tuple[dict, float]]
+) -> None:
+    """Handle `update_ping_period` RPC's together. New ping periods are saved in one transaction
+    and cameras are moved to them in one registry update. If the same camera is updated several
+    times, the latest period wins. Malformed requests are replied "unsuccessful", they don't affect
+    the rest of requests.
+
+    Args:
+        gateway (TBGatewayMqttClient): Gateway to send RPC replies to.
+        requests (list[tuple[dict, float]]): Request bodies and time they were received.
+    """
+    if not requests:
+        return
+
+    # Get camera and new ping period of every request.
+    changes = {}
+    replies = []
+    for request_body, received in requests:
+        try:
+            device = request_body["device"]
+            request_id = str(request_body["data"]["id"])
+            record = registry.by_name(device)
+        except (KeyError, TypeError):
+            logging.warning(f"Malformed 'update_ping_period' is ignored: {request_body}")
+            continue
         try:
+            params = request_body["data"].get("params")
+            if not isinstance(params, dict):
+                raise ValueError(f"params {params!r} are not an object")
+            ping_period = parse_ping_period(params.get("seconds"))
+        except ValueError as e:
+            logging.warning(f"Ping period of {device} is not updated: {e}")
+            ping_period = None
+        if record is not None and ping_period:
+            changes[record.id] = (record, ping_period)
+        replies.append((device, request_id, received, record is not None and bool(ping_period)))
 
-            # Get new ping period and update device
-            ping_period = data["params"]["seconds"]
-            res = update_ping_period(device, ping_period)
+    try:
+        saved = bool(changes) and await asyncio.to_thread(
+            update_ping_periods,
+            [
+                (camera_id, record.ping_period, ping_period)
+                for camera_id, (record, ping_period) in changes.items()
+            ],
+        )
+    except Exception as e:
+        logging.exception(f"Error while executing 'update_ping_period': {e}")
+        saved = False
+
+    # If successfully updated, move cameras to their new pools and send RPC replies "successful".
+    # Otherwise "unsuccessful".
+    if saved:
+        for record, ping_period in changes.values():
+            camera_events.put_nowait(("add", replace(record, ping_period=ping_period)))
+        logging.info(f"Ping period of {len(changes)} cameras updated")
+    for device, request_id, received, valid in replies:
+        gateway.gw_send_rpc_reply(device, request_id, saved and valid)
+        metrics.RPC_DURATION.observe(perf_counter() - received, method="update_ping_period")
+
+
+def execute_rpc(
+    gateway: TBGatewayMqttClient, request_body: dict, data: dict, method: str
+) -> None:
+    """Execute RPC method and send reply.
 
-            # If successfully updated, update db status and send RPC reply "successful"
-            if res:
-                config.db_modified = True
-                gateway.gw_send_rpc_reply(device, request_id, True)
-                logging.info("RPC acknowledged.")
-            # Else send RPC reply "unsuccessful"
-            else:
-                gateway.gw_send_rpc_reply(device, request_id, False)
-        except Exception as e:
-            logging.exception(f"Error while executing 'update_ping_period': {e}")
+    Args:
+        gateway (TBGatewayMqttClient): Gateway to send RPC replies to.
+        request_body (dict): Request body.
+        data (dict): RPC data of request body.
+        method (str): RPC method.
+    """
+    device = request_body["device"]
+    request_id = str(data["id"])
 
+    # Handle RPC according to method name
     if method == "add_device":
         try:
+            params = dict(data["params"])
+            if "ping_period" in params:
+                try:
+                    params["ping_period"] = parse_ping_period(params["ping_period"])
+                except ValueError as e:
+                    logging.warning(f"'add_device' is rejected: {e}")
+                    gateway.gw_send_rpc_reply(device, request_id, False)
+                    return
+            if params.get("probe") is not None:
+                try:
+                    parse_probe(params["probe"])
+                except ValueError as e:
+                    logging.warning(f"'add_device' is rejected: {e}")
+                    gateway.gw_send_rpc_reply(device, request_id, False)
+                    return
 
             # Create new device
-            camera = create_camera(**data["params"])
+            camera = create_camera(**params)
             if camera:
                 logging.info(
                     f"new camera in {__file__}: {camera.name}, {camera.ping_period}"
                 )
 
-                # Put new camera in the pool with it's ping period. If there is no such, create.
-                if cameras_map.get(camera.ping_period):
-                    cameras_map[camera.ping_period][camera.id] = camera
-                else:
-                    cameras_map[camera.ping_period] = {}
-                    cameras_map[camera.ping_period][camera.id] = camera
+                # Put new camera in the pool with it's ping period.
+                push_camera_event("add", CameraRecord.from_model(camera))
 
                 # Send RPC reply "successful"
                 gateway.gw_send_rpc_reply(device, request_id, True)
@@ -94,17 +287,14 @@ def handle_rpc(gateway: TBGatewayMqttClient, request_body: dict) -> None:
 
     if method == "delete_device":
         try:
-            # Get camera from DB
-            camera = get_camera_by_name(data["params"]["name"])
+            # Get camera from registry
+            record = registry.by_name(data["params"]["name"])
 
             # If there is such, delete it from cameras pool and DB
-            if camera:
-                try:
-                    del cameras_map[camera.ping_period][camera.id]
-                except AttributeError:
-                    pass
-
-                res = delete_camera(camera)
+            if record:
+                push_camera_event("remove", record.id)
+                config.cameras_reported.pop(record.name, None)
+                res = delete_camera_by_id(record.id)
 
                 # If camera deleted, send RPC reply "successful"
                 if not res:
@@ -119,322 +309,724 @@ def handle_rpc(gateway: TBGatewayMqttClient, request_body: dict) -> None:
     if method == "update_device":
         try:
 
-            # Get camera from DB
-            camera = get_camera_by_name(data["params"]["name"])
-            if camera:
-
-                # Delete old camera from corresponding cameras pool
-                try:
-                    del cameras_map[camera.ping_period][camera.id]
-                except AttributeError:
-                    pass
+            # Get camera from registry
+            record = registry.by_name(data["params"]["name"])
+            if record:
 
                 # Update camera parameters and save to DB
-                camera.id = data["params"]["id"]
-                camera.ip = data["params"]["ip"]
-                camera.name = data["params"]["newName"]
-                res = update_camera(camera)
+                updated = replace(
+                    record,
+                    id=data["params"]["id"],
+                    ip=data["params"]["ip"],
+                    name=data["params"]["newName"],
+                    edge=data["params"].get("edge", record.edge),
+                    probe=data["params"].get("probe", record.probe),
+                )
+                if updated.probe is not None:
+                    try:
+                        parse_probe(updated.probe)
+                    except ValueError as e:
+                        logging.warning(f"'update_device' is rejected: {e}")
+                        gateway.gw_send_rpc_reply(device, request_id, False)
+                        return
+                res = update_camera_by_id(
+                    record.id,
+                    id=updated.id,
+                    ip=updated.ip,
+                    name=updated.name,
+                    edge=updated.edge,
+                    probe=updated.probe,
+                )
 
-                # If successful, put camera in corresponding cameras pool and send RPC reply "successful".
+                # If successful, replace camera in corresponding cameras pool and send RPC reply "successful".
                 # Otherwise "unsuccessful"
                 if res:
-                    cameras_map[camera.ping_period][camera.id] = camera
+                    push_camera_event("remove", record.id)
+                    push_camera_event("add", updated)
                     gateway.gw_send_rpc_reply(device, request_id, True)
                 else:
                     gateway.gw_send_rpc_reply(device, request_id, False)
 
-            # If camera not found in DB, send RPC reply "unsuccessful"
+            # If camera not found in registry, send RPC reply "unsuccessful"
             else:
                 gateway.gw_send_rpc_reply(device, request_id, False)
 
         except Exception as e:
             logging.exception(f"Error while executing 'update_device': {e}")
 
+    if method == "get_uptime":
+        try:
+            # Report may scan days of probe history, so it is made outside of MQTT thread.
+            asyncio.run_coroutine_threadsafe(
+                reply_uptime(gateway, device, request_id, data.get("params") or {}),
+                event_loop,
+            )
+        except Exception as e:
+            logging.exception(f"Error while executing 'get_uptime': {e}")
+
+    if method in ("add_devices", "sync_devices"):
+        try:
+
+            # Compare given devices with registry. "sync_devices" deletes devices missing in the list.
+            rows = [normalize_row(row) for row in data["params"]["devices"]]
+
+            # Supervisor first asks every region for rows of cameras it already has,
+            # see `Supervisor.fan_out`. Their indexes are sent back, the rest of rows goes to one region.
+            claimed = None
+            if data["params"].get("claimed_only"):
+                claimed = [
+                    index
+                    for index, row in enumerate(rows)
+                    if row and registry.get(row["id"]) is not None
+                ]
+                rows = [rows[index] for index in claimed]
+            changes = diff_cameras(
+                [row for row in rows if row],
+                registry,
+                delete_missing=method == "sync_devices",
+            )
+
+            # Save all changes in one transaction, then apply them to cameras pool and platform.
+            if not changes or apply_changes(changes):
+                for record in changes.deletes:
+                    push_camera_event("remove", record.id)
+                    config.cameras_reported.pop(record.name, None)
+                for record in changes.inserts + changes.updates:
+                    push_camera_event("add", record)
+                asyncio.run_coroutine_threadsafe(
+                    provision_devices(gateway, changes), event_loop
+                )
+
+                # Send RPC reply with amount of changed devices
+                logging.info(f"'{method}' applied: {changes.summary()}")
+                summary = changes.summary()
+                if claimed is not None:
+                    summary["claimed"] = claimed
+                gateway.gw_send_rpc_reply(device, request_id, summary)
+            else:
+                gateway.gw_send_rpc_reply(device, request_id, False)
+
+        except Exception as e:
+            logging.exception(f"Error while executing '{method}': {e}")
+
+
+async def reply_uptime(
+    gateway: TBGatewayMqttClient, device: str, request_id: str, params: dict
+) -> None:
+    """Send availability of cameras as RPC reply, see `ProbeHistory.report`.
+
+    Args:
+        gateway (TBGatewayMqttClient): Gateway to send RPC reply to.
+        device (str): Device of RPC.
+        request_id (str): RPC id.
+        params (dict): "from" and "to" Unix timestamps in milliseconds (last 30 days by default),
+            "by" ("camera", "edge", "region", "group_name" or "all", default) and optional "name".
+    """
+    try:
+        end = params.get("to", time() * 1000) / 1000
+        start = params["from"] / 1000 if "from" in params else end - DEFAULT_RANGE
+        report = await asyncio.to_thread(
+            history.report,
+            list(registry),
+            start,
+            end,
+            params.get("by", "all"),
+            params.get("name"),
+        )
+        gateway.gw_send_rpc_reply(device, request_id, report)
+    except Exception as e:
+        logging.exception(f"Error while executing 'get_uptime': {e}")
+        gateway.gw_send_rpc_reply(device, request_id, False)
+
 
 async def connect_devices(
-    gateway: TBGatewayMqttClient, devices: list, device_type: str = "default"
+    gateway: TBGatewayMqttClient,
+    devices: list,
+    device_type: str = "default",
+    totals: bool = True,
 ) -> None:
-    """Connect given devices to platform.
+    """Connect given devices to platform. Devices are connected in batches of
+    `config.DEVICE_CONNECT_BATCH` with a pause between batches.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway.
         devices (list): List of devices.
         device_type (str, optional): Type of device. Defaults to "default".
+        totals (bool, optional): Connect totals device as well. Defaults to True.
     """
-    gateway.gw_connect_device("CAMERAS_TOTALS", "default")
-    await asyncio.sleep(0.0001)
-    for device in devices:
+    if totals:
+        gateway.gw_connect_device(totals_device, "default")
+    for i, device in enumerate(devices, 1):
         gateway.gw_connect_device(device.name, device_type)
-        await asyncio.sleep(0.0001)
+        if i % config.DEVICE_CONNECT_BATCH == 0:
+            await asyncio.sleep(config.DEVICE_CONNECT_PAUSE)
 
     logging.info(f"{len(devices)} devices successfully connected")
 
 
-async def disconnect_devices(gateway: TBGatewayMqttClient, devices: list) -> None:
+async def disconnect_devices(
+    gateway: TBGatewayMqttClient, devices: list, totals: bool = True
+) -> None:
     """Disconnect given devices from platform.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway.
         devices (list): List of devices.
+        totals (bool, optional): Disconnect totals device as well. Defaults to True.
     """
-    gateway.gw_disconnect_device("CAMERAS_TOTALS")
-    await asyncio.sleep(0.0001)
-    for device in devices:
+    if totals:
+        gateway.gw_disconnect_device(totals_device)
+    for i, device in enumerate(devices, 1):
         gateway.gw_disconnect_device(device.name)
-        await asyncio.sleep(0.0001)
+        if i % config.DEVICE_CONNECT_BATCH == 0:
+            await asyncio.sleep(config.DEVICE_CONNECT_PAUSE)
+
+
+async def provision_devices(
+    gateway: TBGatewayMqttClient, changes: CameraChanges
+) -> None:
+    """Connect new and updated devices to platform and disconnect deleted ones.
+
+    Args:
+        gateway (TBGatewayMqttClient): Gateway.
+        changes (CameraChanges): Applied cameras changes.
+    """
+    await connect_devices(
+        gateway,
+        changes.inserts + changes.updates,
+        device_type=config.TB_DEVICE_PROFILE,
+        totals=False,
+    )
+    await disconnect_devices(gateway, changes.deletes, totals=False)
 
 
-async def ping_camera(
-    gateway: TBGatewayMqttClient, name: str, ip: str, ts: int
-) -> tuple:
-    """Ping device, send telemetry and save data.
+async def probe_ip(ip: str, probe: str | None = None) -> bool:
+    """Probe IP with given backend, see `ProbeEngine.probe`.
+    Result is recorded in link metrics of IP.
+
+    Args:
+        ip (str): IP to probe.
+        probe (str | None, optional): Probe backend, e.g. "tcp:80". Defaults to config.DEFAULT_PROBE.
+
+    Returns:
+        bool: True if IP answered.
+    """
+    metrics.PROBES_IN_FLIGHT.inc()
+    started = perf_counter()
+    try:
+        rtt = await probes.probe(ip, probe)
+    finally:
+        metrics.PROBES_IN_FLIGHT.dec()
+        metrics.PROBE_DURATION.observe(perf_counter() - started)
+    link_stats.record(ip, rtt)
+    return rtt is not None
+
+
+def report_status(
+    name: str,
+    connection_status: int,
+    ts: datetime,
+    unreachable: bool | None = None,
+    stats: dict | None = None,
+    flapping: bool = False,
+    timed_out: bool = False,
+) -> int | str:
+    """Put device status telemetry in batch, it is sent together with other devices telemetry.
+    Unchanged status is sent only as a periodic heartbeat. Status changes of flapping device
+    are not sent until it stops flapping. Link metrics are sent with every result anyway,
+    so degrading link is seen before camera goes offline.
 
     Args:
-        gateway (TBGatewayMqttClient): Gateway to send data to.
         name (str): Device name.
-        ip (str): Device IP.
-        ts (int): Timestamp when operation was executed. Sent to platform as timeseries timestamp.
+        connection_status (int): Device connection status.
+        ts (datetime): Sent to platform as timeseries timestamp.
+        unreachable (bool | None, optional): Whether device edge is down. None if edge is not monitored.
+        stats (dict | None, optional): Link metrics sent along with status. Defaults to None.
+        flapping (bool, optional): Whether device is flapping. Defaults to False.
+        timed_out (bool, optional): Whether ping was cancelled at it's deadline. Defaults to False.
 
     Returns:
-        tuple: Cameras current connection status and it's IP.
+        int | str: State of device: connection status, "flapping", "timeout" or "unreachable".
     """
+    # Form telemetry with timestamp
+    telemetry = {
+        "online": connection_status,
+        "flapping": int(flapping),
+        "timeout": int(timed_out),
+    }
+    if unreachable is not None:
+        telemetry["unreachable"] = int(unreachable)
+    if stats:
+        telemetry.update(stats)
+    data = [{"ts": datetime.timestamp(ts) * 1000, "values": telemetry}]
+
+    if unreachable:
+        state = "unreachable"
+    elif flapping:
+        state = "flapping"
+    elif timed_out:
+        state = "timeout"
+    else:
+        state = connection_status
+    if should_report(name, state):
+        aggregator.add(name, data)
+    elif stats:
+        aggregator.add(name, {"ts": data[0]["ts"], "values": stats})
+    return state
+
+
+def handle_ping_result(
+    record: CameraRecord, up: bool | None, ts: datetime, timed_out: bool = False
+) -> int:
+    """Pass ping result through status state machine, so reported status changes only after
+    several consistent results. Send telemetry, update cameras totals and buffer result to be saved in DB.
+
+    Args:
+        record (CameraRecord): Camera.
+        up (bool | None): Whether camera answered. None if it's edge is unreachable.
+        ts (datetime): Time of ping. Sent to platform as timeseries timestamp.
+        timed_out (bool, optional): Whether ping was cancelled at it's deadline, it counts
+            as failed. Defaults to False.
 
-    connection_status = 0
+    Returns:
+        int: Cameras current connection status.
+    """
+    connection_status, flapping = 0, False
+    if up is not None:
+        connection_status, flapping = status_filter.update(record.id, up)
+
+    state = report_status(
+        record.name,
+        connection_status,
+        ts,
+        (up is None) if record.edge in edge_monitor.edges else None,
+        link_stats.summary(record.ip) if config.LINK_STATS_TELEMETRY else None,
+        flapping,
+        timed_out,
+    )
+    totals.set(record.id, connection_status)
+    rtt = link_stats.last(record.ip) if up else None
+    store.record(
+        record.id,
+        connection_status,
+        ts,
+        flapping,
+        status_filter.history(record.id),
+        rtt,
+        state,
+    )
+    history.append(record.id, datetime.timestamp(ts), connection_status, rtt)
+    return connection_status
+
+
+async def ping_camera(record: CameraRecord) -> tuple:
+    """Ping device. Device behind an unreachable edge is not pinged.
+
+    Args:
+        record (CameraRecord): Camera.
+
+    Returns:
+        tuple: Whether camera answered (None if it's edge is unreachable) and time of ping.
+    """
+
+    # Time of ping is sent to platform as timeseries timestamp.
+    ts = datetime.now()
+    if edge_monitor.is_down(record.edge):
+        return None, ts
     try:
-        # Ping device
-        creating_process = datetime.now()
-        process = await asyncio.create_subprocess_exec(
-            "ping",
-            "-c",
-            config.PING_COUNT,
-            "-i",
-            config.PING_INTERVAL,
-            ip,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.DEVNULL,
-        )
-        new_time = datetime.now()
-        if (new_time - creating_process) > timedelta(seconds=30):
-            logging.info(
-                f"Creating process took {datetime.now() - creating_process} sec"
-            )
-        await process.communicate()
-        connection_status = 1 if process.returncode == 0 else 0
+        return await probe_ip(record.ip, record.probe), ts
+    except Exception as e:
+        logging.error(f"Error in getting device {record.name} ({record.ip}) connection: {e}")
+        return False, ts
 
-        # Form telemetry with timestamp
-        telemetry = {"online": connection_status}
-        ts = datetime.timestamp(ts) * 1000
-        data = [{"ts": ts, "values": telemetry}]
 
-        # Send telemetry
-        gateway.gw_send_telemetry(name, data)
+async def limited_ping_camera(record: CameraRecord) -> tuple:
+    """Ping device within global concurrency and rate limits, shared by all probe backends.
+    Devices behind an unreachable edge are not pinged, so they bypass limits.
 
-        # TODO: update camera values in BD
+    Returns:
+        tuple: Whether camera answered (None if it's edge is unreachable) and time of ping.
+    """
+    if edge_monitor.is_down(record.edge):
+        return await ping_camera(record)
+    async with limiter:
+        return await ping_camera(record)
 
-        # global devices_connections_changed
-        # devices_connections_changed += 1
 
-    except asyncio.exceptions.TimeoutError as e:
-        logging.exception(f"Timeout while ping {e}")
-    except Exception as e:
-        error_msg = f"Error in getting device {name} ({ip}) connection: {e}"
-        logging.error(error_msg)
+def mark_edge(edge: str, up: bool) -> None:
+    """Callback for edge state changes. When edge goes down, all cameras behind it
+    are reported offline right away. When it is up again, they are pinged in their next cycle.
+    Their status before outage is stale by then, so they start over from unknown status.
 
-    # Return cameras current connection status and it's IP.
-    return connection_status, ip
+    Args:
+        edge (str): Edge name.
+        up (bool): Whether edge is reachable.
+    """
+    if probe_pool is not None:
+        probe_pool.set_edge(edge, up)
+    if up:
+        return
 
+    ts = datetime.now()
+    cameras = registry.by_edge(edge)
+    for camera in cameras:
+        status_filter.remove(camera.id)
+        totals.set(camera.id, 0)
+        report_status(camera.name, 0, ts, unreachable=True)
+    logging.info(f"{len(cameras)} cameras behind edge {edge} marked unreachable")
 
-async def ping_cameras_list(gateway: TBGatewayMqttClient, period: int) -> None:
-    """This coroutine creates tasks for each device and waits for tasks to complete.
-       Then sleeps for cetain amount of time.
-       Works in loop.
+
+async def probe_camera(
+    gateway: TBGatewayMqttClient, record: CameraRecord, due: float
+) -> None:
+    """Ping camera and handle result. Ping has to finish within PROBE_DEADLINE share of ping period
+    after it came due, time waiting for probe limits included. Otherwise it is cancelled,
+    it's echo requests or `ping` process are cleaned up, and camera is reported as timed out,
+    so it's next ping starts on time.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway.
-        period (int): Ping period.
+        record (CameraRecord): Camera.
+        due (float): Monotonic deadline of ping.
     """
     ts = datetime.now()
-
-    while True:
-        # All telemetry will be sent with same timestamp, which is created at this point.
-        time_start = time()
-
-        # Get cameras with given ping period from cameras pool.
-        devices = cameras_map.get(period, {}).values()
-
-        # If there is no devices with given ping period, suspend.
-        if len(devices) == 0:
-            await asyncio.sleep(period)
-
-        # Create task of camera ping for every device.
-        creating_coros = datetime.now()
-        tasks = []
-        for device in devices:
-            tasks.append(ping_camera(gateway, device.name, device.ip, ts))
-        logging.info(f"Creating coros took {datetime.now() - creating_coros} sec")
-
-        # Wait for every task to be completed.
-        gatehring_tasks = datetime.now()
-        finished = await asyncio.gather(*tasks)
-        logging.info(f"implementing coros took {datetime.now() - gatehring_tasks} sec")
-
-        # Update amount of cameras online and collect camera's statuses in list.
-        updating = datetime.now()
-        results = []
-        for task in finished:
-            status, ip = task[0], task[1]
-            config.cameras_online[ip] = status
-            results.append(status)
-        logging.info(f"Updating took {datetime.now() - updating} sec")
-
-        # Calculate time to wait till next iteration and suspend coroutine.
-        # If time to wait is less than 0, restart iteration immediately.
-        time_end = time()
-        time_to_wait = period - (time_end - time_start)
-        logging.info(
-            f"With period {period} ({len(devices)} items). Coroutine finished in {time_end-time_start} sec. \
-            Next iteration in {time_to_wait} sec."
+    deadline = due + record.ping_period * config.PROBE_DEADLINE
+    try:
+        result = await asyncio.wait_for(
+            limited_ping_camera(record), max(0.0, deadline - monotonic())
         )
-        ts += timedelta(seconds=period)
-        if time_to_wait > 0 and ts > datetime.now():
-            await asyncio.sleep(time_to_wait)
+    except asyncio.TimeoutError:
+        metrics.PROBE_OVERRUNS.inc(period=record.ping_period)
+        link_stats.record(record.ip, None)
+        handle_ping_result(record, False, ts, timed_out=True)
+        return
+    handle_ping_result(record, *result)
 
 
-async def check_db(gateway: TBGatewayMqttClient) -> None:
-    """Check if there are modified data in cameras table. This coroutine will take them and add to common pool.
+def dispatch_probe(gateway: TBGatewayMqttClient, camera_id: str, due: float) -> None:
+    """Callback of scheduler, starts ping of camera that came due.
+    If previous ping of camera is still running, this one is skipped.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway.
+        camera_id (str): Camera.id.
+        due (float): Monotonic deadline of ping.
     """
-    # Update cameras pinging strategy if there are changes in DB.
-    while True:
-        # logging.info(cameras_map)
-        logging.info(coroutines_map)
+    record = registry.get(camera_id)
+    if record is None:
+        scheduler.remove(camera_id)
+        return
+    if camera_id in probe_tasks:
+        metrics.PROBES_SKIPPED.inc(period=record.ping_period)
+        return
+
+    metrics.PROBE_LATENESS.observe(max(0.0, monotonic() - due), period=record.ping_period)
+    task = asyncio.create_task(probe_camera(gateway, record, due))
+    probe_tasks[camera_id] = task
+    task.add_done_callback(lambda _: probe_tasks.pop(camera_id, None))
+
+
+def handle_worker_result(
+    record: CameraRecord, status: int, rtt: float | None, ts: float
+) -> None:
+    """Callback of probe pool, handles ping result of camera written by worker process.
 
-        # Check if there are changes in DB. Suspend otherwise.
-        if config.db_modified:
+    Args:
+        record (CameraRecord): Camera.
+        status (int): 1 if camera answered, 0 if not, TIMED_OUT if ping was cancelled at it's deadline,
+            UNREACHABLE if it's edge is unreachable.
+        rtt (float | None): RTT in seconds.
+        ts (float): Time of ping, Unix timestamp.
+    """
+    if status == UNREACHABLE or edge_monitor.is_down(record.edge):
+        handle_ping_result(record, None, datetime.fromtimestamp(ts))
+        return
 
-            # Get all newly modified cameras from DB.
-            modified_cameras = get_modified_cameras()
-            logging.info(
-                f"Updating camera pool with: {len(modified_cameras)} new items"
-            )
+    link_stats.record(record.ip, rtt)
+    if status == TIMED_OUT:
+        metrics.PROBE_OVERRUNS.inc(period=record.ping_period)
+    handle_ping_result(
+        record, status == 1, datetime.fromtimestamp(ts), timed_out=status == TIMED_OUT
+    )
 
-            # Delete every modified camera from corresponding cameras pool if ping period was modified.
-            # Put camera in it's cameras pool if it exists.
-            # If not, create the pool and put camera in it.
-            for camera in modified_cameras:
-                try:
-                    del cameras_map[camera.prev_ping_period][camera.id]
-                except Exception:
-                    pass
-                if cameras_map.get(camera.ping_period):
-                    cameras_map[camera.ping_period][camera.id] = camera
-                else:
-                    cameras_map[camera.ping_period] = {}
-                    cameras_map[camera.ping_period][camera.id] = camera
-                camera.status = 0
 
-            # Flush cameras modified status after we implemented all the logic.
-            flush_cameras_changes(modified_cameras)
-            config.db_modified = False
+def schedule_camera(record: CameraRecord) -> None:
+    """Schedule ping of camera, in main process or in probe worker."""
+    if probe_pool is not None:
+        probe_pool.add(record)
+    else:
+        scheduler.add(record.id, record.ping_period)
 
-            # Make sure every camera pool gets handled in it's asyncronous task.
-            # If there is no task for some camera pool, create and run it.
-            for key in cameras_map.keys():
-                if not coroutines_map.get(key):
-                    coro = ping_cameras_list(gateway, key)
-                    asyncio.create_task(coro)
-                    coroutines_map[key] = coro
 
-        logging.info("DB has been checked. Next iteration in 60 sec.")
-        await asyncio.sleep(60)
+def unschedule_camera(camera_id: str) -> None:
+    if probe_pool is not None:
+        probe_pool.remove(camera_id)
+    else:
+        scheduler.remove(camera_id)
 
 
-async def report_total_cameras_online(gateway: TBGatewayMqttClient) -> None:
-    """Send data of how many cameras are currently online and offline.
+def update_schedule_metrics() -> None:
+    """Set amount of scheduled cameras by ping period."""
+    metrics.CAMERAS_SCHEDULED.clear()
+    for period in registry.periods():
+        metrics.CAMERAS_SCHEDULED.set(len(registry.by_period(period)), period=period)
+
+
+def recover_modified_cameras() -> None:
+    """Flush Camera.status of cameras that were modified, but not applied before restart.
+    Their current ping period is already used when registry is loaded from DB.
+    """
+    modified = clear_all_modified_status()
+    if modified:
+        logging.info(f"Recovered {modified} modified cameras")
+
+
+async def process_camera_events(gateway: TBGatewayMqttClient) -> None:
+    """Apply cameras registry changes pushed by RPC handlers as soon as they arrive.
 
     Args:
         gateway (TBGatewayMqttClient): Gateway.
     """
+    while True:
+        # Wait for event, then take every event that is already queued.
+        events = [await camera_events.get()]
+        while not camera_events.empty():
+            events.append(camera_events.get_nowait())
+
+        try:
+            added = []
+            async with registry_lock:
+                for action, arg in events:
+                    if action == "remove":
+                        record = registry.remove(arg)
+                        unschedule_camera(arg)
+                        totals.remove(arg)
+                        status_filter.remove(arg)
+                        if record is not None and not registry.by_ip(record.ip):
+                            link_stats.remove(record.ip)
+                    elif action == "add":
+                        registry.add(arg)
+                        schedule_camera(arg)
+                        totals.add(arg)
+                        added.append(arg.id)
+            update_schedule_metrics()
+
+            # Flush cameras modified status after we implemented all the logic.
+            await asyncio.to_thread(clear_modified_status, added)
+        except Exception as e:
+            logging.exception(f"Error while updating cameras registry: {e}")
+        logging.info(f"Cameras registry updated with {len(events)} changes")
+
+
+def totals_device_name(key: tuple | None) -> str:
+    """Get name of device, that totals of key are sent to. In region worker names start with
+    it's own totals device, so totals of groups spread over several regions don't overwrite each other,
+    supervisor sums them up, see `Supervisor.add_totals`.
+
+    Args:
+        key (tuple | None): None for all cameras, (dimension, value) otherwise.
+
+    Returns:
+        str: Device name, e.g. "CAMERAS_TOTALS region Караганда".
+    """
+    if key is None:
+        return totals_device
+    return f"{totals_device} {key[0]} {key[1]}"
+
 
-    # Should be started with suspention.
-    await asyncio.sleep(120)
+async def report_totals(gateway: TBGatewayMqttClient, interval: float) -> None:
+    """Send how many cameras are online and offline, overall and by region, edge and group.
+    Only totals changed since previous report are sent, all in one batch.
+
+    Args:
+        gateway (TBGatewayMqttClient): Gateway.
+        interval (float): Seconds between reports.
+    """
     while True:
+        await asyncio.sleep(interval)
+        ts = int(time() * 1000)
+        for key, (total, online) in totals.take_changed().items():
+            device = totals_device_name(key)
+            if key is not None and device not in totals_devices:
+                gateway.gw_connect_device(device, "default")
+                totals_devices.add(device)
+            aggregator.add(
+                device,
+                {
+                    "ts": ts,
+                    "values": {
+                        "total devices": total,
+                        "active devices": online,
+                        "inactive devices": total - online,
+                    },
+                },
+            )
+
 
-        # Calculate online, offline and total count of cameras.
-        total = len(config.cameras_online)
-        online = sum(config.cameras_online.values())
-        offline = total - online
-
-        # Send data on platform.
-        gateway.gw_send_telemetry(
-            config.TB_TOTALS_DEVICE_NAME,
-            {
-                "total devices": total,
-                "active devices": online,
-                "inactive devices": offline,
-            },
+async def report_metrics(interval: float) -> None:
+    """Send runtime metrics as telemetry of totals device every `interval` seconds.
+    Does nothing if interval is 0.
+
+    Args:
+        interval (float): Seconds between reports.
+    """
+    if not interval:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        aggregator.add(
+            totals_device,
+            {"ts": int(time() * 1000), "values": metrics.snapshot()},
         )
 
-        # Suspend iteration.
-        await asyncio.sleep(60)
 
+async def main(
+    gateway: TBGatewayMqttClient | None = None,
+    metrics_port: int | None = None,
+    region_totals_device: str | None = None,
+) -> None:
+    """Programm main entry.
 
-async def main() -> None:
-    """Programm main entry."""
+    Args:
+        gateway (TBGatewayMqttClient | None, optional): Gateway to use. Region workers pass
+            supervisor's gateway proxy. Defaults to new gateway connected to config.CUBA_URL.
+        metrics_port (int | None, optional): Port to serve metrics on, 0 disables.
+            Region workers pass their own port. Defaults to config.METRICS_PORT.
+        region_totals_device (str | None, optional): Device totals and metrics of region worker are sent to,
+            supervisor sums up overall totals of regions. Defaults to config.TB_TOTALS_DEVICE_NAME.
+    """
+    global event_loop, totals_device
+    if region_totals_device:
+        totals_device = region_totals_device
     try:
         # Initialize and connect gateway.
-        gateway = TBGatewayMqttClient(
-            config.CUBA_URL,
-            1883,
-            config.TB_GATEWAY_TOKEN,
-            client_id=config.TB_CLIENT_ID,
-        )
+        if gateway is None:
+            gateway = TBGatewayMqttClient(
+                config.CUBA_URL,
+                1883,
+                config.TB_GATEWAY_TOKEN,
+                client_id=config.TB_CLIENT_ID,
+            )
         gateway.connect()
 
-        # Add callback to handle RPC's from platform.
+        # Telemetry of all devices is published through aggregator.
+        aggregator.start(gateway)
+
+        # Add callback to handle RPC's from platform. It is called from MQTT thread
+        # and passes cameras pool changes to the event loop.
+        event_loop = asyncio.get_running_loop()
         gateway.gw_set_server_side_rpc_request_handler(handle_rpc)
+        metrics.PUBLISH_QUEUE_DEPTH.set_function(lambda: pending_publishes(gateway))
+        metrics.SPOOLED_ROWS.set_function(lambda: len(aggregator.spool))
 
         logging.info(f"Gateway connected on {config.CUBA_URL}")
 
-        # Get all cameras from DB. Map their current status.
-        cameras = get_all_cameras()
-        for camera in cameras:
-            config.cameras_online[camera.ip] = 0
-
-        # Connect devices
-        await connect_devices(gateway, cameras, device_type=config.TB_DEVICE_PROFILE)
-
-        # Map cameras acc. to its ping time as key and id:camera list as value.
-        periods = get_unique_ping_periods()
-        for period in periods:
-            cameras = get_cameras_by_ping_period(period)
-            cameras_map[period] = {camera.id: camera for camera in cameras}
-
-        for key in cameras_map.keys():
-            logging.info(f"With period {key}: {len(cameras_map[key])} items.")
-
-        # For every key:item initialize coroutine. Map them by ping period.
-        for key, item in cameras_map.items():
-            coroutine = ping_cameras_list(gateway=gateway, period=key)
-            coroutines_map[key] = coroutine
+        # Open shared ICMP socket. Fall back to `ping` subprocess if it is not permitted.
+        # It is used for edges, and for cameras if they are not pinged by workers.
+        if config.PROBE_BACKEND == "icmp":
+            probes.open()
+
+        # Fail right away if probe history is already written by another process.
+        history.open()
+
+        # Stream all cameras from DB in registry, it indexes them by ping period among others.
+        # Restore status state machine and RTT of every camera, so it continues where it stopped,
+        # and count cameras online. Status published before restart is not published again
+        # until it changes, so restart is not visible on platform.
+        recover_modified_cameras()
+        last_pings = {}
+        rtts = {}
+        for row in iter_camera_rows():
+            record = CameraRecord.from_model(row)
+            # Ping periods were not validated before, so DB may hold ones that can't be scheduled.
+            if not isinstance(row.ping_period, int) or row.ping_period <= 0:
+                logging.error(
+                    f"Camera {row.name} has invalid ping period {row.ping_period!r}, "
+                    f"it is pinged every {DEFAULT_PING_PERIOD} seconds"
+                )
+                record = replace(record, ping_period=DEFAULT_PING_PERIOD)
+            registry.add(record)
+            status_filter.restore(row.id, row.online, row.flapping, row.history)
+            status, flapping = status_filter.status(row.id)
+            totals.add(record, max(0, status))
+            if row.reported is not None:
+                reported = row.reported
+                restore_reported(record.name, int(reported) if reported.isdigit() else reported)
+            elif status != UNKNOWN:
+                restore_reported(record.name, "flapping" if flapping else status)
+            if row.rtt is not None:
+                rtts[row.id] = row.rtt
+                probes.restore(record.ip, record.probe, row.rtt)
+            last_pings[row.id] = row.last_ping
+        for period in registry.periods():
+            logging.info(f"With period {period}: {len(registry.by_period(period))} items.")
+
+        # The first wave pings cameras in order of their last ping, oldest first, spread over
+        # STARTUP_RAMP seconds, then every camera is pinged at it's phase offset within ping period.
+        # Deadlines are the same in workers, so devices are still connected in order of first ping.
+        first_due = {}
+        started = monotonic()
+        ramp = sorted(registry, key=lambda record: last_pings[record.id] or datetime.min)
+        for rank, record in enumerate(ramp):
+            window = min(config.STARTUP_RAMP, record.ping_period)
+            first_due[record.id] = started + window * rank / len(ramp)
+            scheduler.add(record.id, record.ping_period, first_due[record.id])
+        if probe_pool is not None:
+            probe_pool.start(registry, config.PROBE_WORKER_SLOTS, first_due, rtts)
+        update_schedule_metrics()
 
         # Run all coroutines.
-        # TODO: run a coroutine that will check if there were changes in DB via RPC
         await asyncio.gather(
-            # Coroutines list, that pings cameras.
-            *coroutines_map.values(),
-            # Coroutine, that checks if DB was modified and applies needed logic if necessary.
-            check_db(gateway),
+            # Coroutine, that connects devices in batches while they are already being pinged.
+            # Devices are connected in order of their first ping.
+            connect_devices(
+                gateway,
+                sorted(registry, key=lambda record: scheduler.deadline(record.id)),
+                device_type=config.TB_DEVICE_PROFILE,
+            ),
+            # Coroutine, that starts ping of every camera as it comes due,
+            # or handles results of probe workers.
+            (
+                probe_pool.run(handle_worker_result)
+                if probe_pool is not None
+                else scheduler.run(lambda camera_id, due: dispatch_probe(gateway, camera_id, due))
+            ),
+            # Coroutines, that execute RPC's and apply cameras pool changes made by them.
+            process_rpc_requests(gateway),
+            process_camera_events(gateway),
+            # Coroutine, that replays telemetry spooled while gateway was disconnected.
+            aggregator.replay(config.SPOOL_REPLAY_RATE),
+            # Coroutine, that saves ping results in DB.
+            store.run(),
+            # Coroutine, that appends ping results to probe history.
+            history.run(config.HISTORY_FLUSH_INTERVAL),
+            # Coroutine, that pings edges and suspends pinging of cameras behind unreachable ones.
+            edge_monitor.run(probe_ip, mark_edge),
+            # Coroutines, that collect, serve and report runtime metrics.
+            metrics.monitor_loop_lag(),
+            metrics.serve(
+                config.METRICS_HOST,
+                config.METRICS_PORT if metrics_port is None else metrics_port,
+            ),
+            report_metrics(config.METRICS_TELEMETRY_INTERVAL),
             # Coroutine that sends telemetry of devices count online, devices count offline, devices count total.
-            # report_total_cameras_online(gateway),
+            report_totals(gateway, config.TOTALS_INTERVAL),
         )
 
     except Exception as e:
         logging.exception(e)
     finally:
-        await disconnect_devices(gateway, cameras)
+        aggregator.flush()
+        aggregator.spool.close()
+        await store.flush()
+        store.close()
+        history.flush()
+        probes.close()
+        if probe_pool is not None:
+            probe_pool.close()
+        for device in totals_devices:
+            gateway.gw_disconnect_device(device)
+        await disconnect_devices(gateway, list(registry))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+"""
+Here are implemented runtime metrics of the service. Metrics are kept in process memory and served
+in Prometheus text format over HTTP, or sent to platform as telemetry of the totals device.
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+from time import perf_counter
+from typing import Callable
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REGISTRY = []
+
+
+def escape(value: str) -> str:
+    """Escape label value for text exposition format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """Base of metrics. Values are kept by label values.
+    Metrics may be updated from MQTT thread, so values are copied before they are read.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def clear(self) -> None:
+        """Forget values of all labels."""
+        self._values = {}
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """Get (name, labels, value) of every sample."""
+        return [
+            (self.name, self._labels(key), value) for key, value in list(self._values.items())
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Take value from function each time metric is read."""
+        self._function = function
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        if self._function is not None:
+            try:
+                return [(self.name, "", self._function())]
+            except Exception as e:
+                logging.error(f"Error while reading metric {self.name}: {e}")
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Bucket counts, sum, count.
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        samples = []
+        for key, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(
+                    (f"{self.name}_bucket", self._labels(key, f'le="{bound}"'), cumulative)
+                )
+            samples.append((f"{self.name}_bucket", self._labels(key, 'le="+Inf"'), count))
+            samples.append((f"{self.name}_sum", self._labels(key), total))
+            samples.append((f"{self.name}_count", self._labels(key), count))
+        return samples
+
+
+def timed(histogram: Histogram, **labels) -> Callable:
+    """Decorator, that observes duration of function calls in histogram."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """Get all metrics in Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    """Get flat metrics summary for telemetry: gauges and counters as they are,
+    histograms as average and count.
+    """
+    values = {}
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge) and metric._function is not None:
+            values.update((name, value) for name, _, value in metric.samples())
+            continue
+        for key, value in list(metric._values.items()):
+            name = metric.name + "".join(f"_{label}" for label in key)
+            if isinstance(metric, Histogram):
+                _, total, count = value
+                values[f"{name}_avg"] = round(total / count, 6) if count else 0
+                values[f"{name}_count"] = count
+            else:
+                values[name] = value
+    return values
+
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer every HTTP request with metrics."""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> None:
+    """Serve metrics over HTTP forever. Does nothing if port is 0."""
+    if not port:
+        return
+    server = await asyncio.start_server(handle_http, host, port)
+    logging.info(f"Metrics are served on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Observe how late the event loop wakes up a sleeping coroutine."""
+    while True:
+        started = perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(perf_counter() - started - interval)
+
+
+PROBE_LATENESS = Histogram(
+    "cameras_probe_lateness_seconds",
+    "Delay of ping start after it's deadline, by ping period.",
+    ("period",),
+)
+PROBES_SKIPPED = Counter(
+    "cameras_probes_skipped_total",
+    "Pings skipped because previous ping of camera was still running, by ping period.",
+    ("period",),
+)
+PROBE_OVERRUNS = Counter(
+    "cameras_probe_overruns_total",
+    "Pings cancelled because they didn't finish by their deadline, by ping period.",
+    ("period",),
+)
+CAMERAS_SCHEDULED = Gauge(
+    "cameras_scheduled", "Cameras scheduled for ping, by ping period.", ("period",)
+)
+PROBE_DURATION = Histogram("cameras_probe_duration_seconds", "Duration of camera ping.")
+PROBES_IN_FLIGHT = Gauge("cameras_probes_in_flight", "Pings running at the moment.")
+EVENT_LOOP_LAG = Histogram(
+    "cameras_event_loop_lag_seconds",
+    "Delay of event loop wake ups.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+PUBLISH_QUEUE_DEPTH = Gauge(
+    "cameras_publish_queue_depth", "MQTT messages waiting to be sent."
+)
+SPOOLED_ROWS = Gauge(
+    "cameras_spooled_rows", "Device telemetry rows in spool, waiting to be replayed."
+)
+RPC_DURATION = Histogram(
+    "cameras_rpc_duration_seconds",
+    "Duration of RPC handling, by method (\"other\" for unknown methods).",
+    ("method",),
+)
+DB_OPERATION_DURATION = Histogram(
+    "cameras_db_operation_seconds", "Duration of DB operations.", ("operation",)
+)
@@ -22,4 +22,18 @@ class Camera(Base):
     ping_period: Mapped[int] = mapped_column(default=60)
     prev_ping_period: Mapped[int] = mapped_column(default=60)
     last_ping: Mapped[datetime] = mapped_column(nullable=True)
+    online: Mapped[int] = mapped_column(default=0)
+    # Status state machine, see `hysteresis.StatusFilter`.
+    flapping: Mapped[int] = mapped_column(default=0)
+    history: Mapped[int] = mapped_column(default=0)
+    # State last published to platform: "0", "1", "flapping", "timeout" or "unreachable",
+    # see `main.report_status`. It is not published again after restart until it changes.
+    reported: Mapped[str] = mapped_column(String(20), nullable=True)
+    # Last RTT in seconds, seeds RTT estimator of camera after restart.
+    rtt: Mapped[float] = mapped_column(nullable=True)
+    edge: Mapped[str] = mapped_column(String(20), nullable=True, index=True)
+    region: Mapped[str] = mapped_column(String(50), nullable=True)
+    group_name: Mapped[str] = mapped_column(String(150), nullable=True)
+    # Probe backend, e.g. "icmp", "tcp:80", "rtsp:554". config.DEFAULT_PROBE if not set.
+    probe: Mapped[str] = mapped_column(String(20), nullable=True)
     status: Mapped[int] = mapped_column(default=0, index=True)
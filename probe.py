@@ -0,0 +1,408 @@
+"""
+Here is implemented the probe engine. All ICMP echo requests are sent from a single socket
+and replies are matched to waiting probes by identifier and sequence number.
+Cameras that filter ICMP are probed with TCP connect or RTSP OPTIONS request instead,
+all backends run on the event loop and share the same echo interface.
+"""
+
+import asyncio
+import functools
+import logging
+import math
+import os
+import socket
+import struct
+from typing import Awaitable, Callable
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+PAYLOAD = b"cuba-cameras-integration".ljust(32, b"\x00")
+
+# Probe backends and their default ports.
+PROBE_PORTS = {"icmp": None, "tcp": 554, "rtsp": 554}
+
+
+@functools.lru_cache(maxsize=None)
+def parse_probe(value: str) -> tuple[str, int | None]:
+    """Parse probe setting of camera in "backend[:port]" format, e.g. "icmp", "tcp:80", "rtsp:8554".
+
+    Args:
+        value (str): Probe setting.
+
+    Returns:
+        tuple[str, int | None]: Backend and port. Port is None for ICMP.
+
+    Raises:
+        ValueError: If value is not a string, backend is unknown or port is not a valid port number.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid probe {value!r}")
+    backend, _, port = value.strip().lower().partition(":")
+    if backend not in PROBE_PORTS:
+        raise ValueError(f"Unknown probe backend '{backend}'")
+    if backend == "icmp":
+        return backend, None
+    if not port:
+        return backend, PROBE_PORTS[backend]
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid probe port '{port}'")
+    return backend, int(port)
+
+
+def checksum(packet: bytes) -> int:
+    """Calculate internet checksum (RFC 1071) of given packet.
+
+    Args:
+        packet (bytes): ICMP packet.
+
+    Returns:
+        int: Checksum.
+    """
+    if len(packet) % 2:
+        packet += b"\x00"
+    total = sum(struct.unpack(f"!{len(packet) // 2}H", packet))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpProber:
+    """Sends ICMP echo requests from one non-blocking socket.
+
+    Unprivileged datagram ICMP socket is used where kernel allows it
+    (net.ipv4.ping_group_range), raw socket is used as a fallback.
+    """
+
+    def __init__(self) -> None:
+        self._sock = None
+        self._raw = False
+        self._ident = os.getpid() & 0xFFFF
+        self._seq = 0
+        self._waiters = {}
+
+    @property
+    def is_open(self) -> bool:
+        return self._sock is not None
+
+    def open(self) -> None:
+        """Open ICMP socket and start reading replies in the running event loop.
+
+        Raises:
+            OSError: If neither datagram nor raw ICMP socket could be opened.
+        """
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self._raw = False
+        except OSError:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self._raw = True
+        sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+        self._sock = sock
+        logging.info(f"ICMP prober opened ({'raw' if self._raw else 'datagram'} socket)")
+
+    def close(self) -> None:
+        """Close socket and release all waiting probes."""
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        for waiter in self._waiters.values():
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters.clear()
+
+    def _packet(self, seq: int) -> bytes:
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self._ident, seq)
+        csum = checksum(header + PAYLOAD)
+        return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, self._ident, seq) + PAYLOAD
+
+    def _on_readable(self) -> None:
+        """Drain socket and resolve probes waiting for received replies."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data, addr = self._sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.error(f"Error while reading ICMP socket: {e}")
+                return
+
+            # Raw socket delivers IP header as well.
+            if self._raw:
+                data = data[(data[0] & 0x0F) * 4 :]
+            if len(data) < 8:
+                continue
+
+            icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", data[:8])
+            if icmp_type != ICMP_ECHO_REPLY:
+                continue
+            # Datagram socket gets only its own replies, identifier is rewritten by kernel.
+            if self._raw and ident != self._ident:
+                continue
+
+            waiter = self._waiters.get((addr[0], seq))
+            if waiter is not None and not waiter.done():
+                waiter.set_result(loop.time())
+
+    async def echo(self, ip: str, timeout: float) -> float | None:
+        """Send single echo request and wait for reply.
+
+        Args:
+            ip (str): Device IP.
+            timeout (float): Seconds to wait for reply.
+
+        Returns:
+            float | None: Round trip time in seconds. None if reply was not received in time.
+        """
+        loop = asyncio.get_running_loop()
+        self._seq = (self._seq + 1) & 0xFFFF
+        key = (ip, self._seq)
+        waiter = loop.create_future()
+        self._waiters[key] = waiter
+        try:
+            sent = loop.time()
+            await loop.sock_sendto(self._sock, self._packet(self._seq), (ip, 0))
+            received = await asyncio.wait_for(waiter, timeout)
+            return received - sent
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiters.pop(key, None)
+
+
+class RttEstimator:
+    """Smoothed RTT and RTT variation per IP (same as TCP retransmission timer, RFC 6298).
+    Used to pick a short timeout for the first echo request.
+    """
+
+    def __init__(self, min_timeout: float, max_timeout: float) -> None:
+        """
+        Args:
+            min_timeout (float): Lowest timeout, seconds.
+            max_timeout (float): Highest timeout, used while RTT of IP is unknown. Seconds.
+        """
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._rtt = {}
+
+    def __contains__(self, ip: str) -> bool:
+        return ip in self._rtt
+
+    def timeout(self, ip: str) -> float:
+        if ip not in self._rtt:
+            return self.max_timeout
+        srtt, rttvar = self._rtt[ip]
+        return min(max(srtt + 4 * rttvar, self.min_timeout), self.max_timeout)
+
+    def update(self, ip: str, rtt: float) -> None:
+        if ip not in self._rtt:
+            self._rtt[ip] = (rtt, rtt / 2)
+            return
+        srtt, rttvar = self._rtt[ip]
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+        srtt = 0.875 * srtt + 0.125 * rtt
+        self._rtt[ip] = (srtt, rttvar)
+
+
+async def adaptive_ping(
+    echo: Callable[[str, float], Awaitable[float | None]],
+    ip: str,
+    count: int,
+    interval: float,
+    estimator: RttEstimator,
+) -> float | None:
+    """Send single echo request with adaptive timeout. Further requests (with full timeout,
+    no more often than `interval`) are sent only if it is lost, `count` requests at most.
+
+    Args:
+        echo (Callable[[str, float], Awaitable[float | None]]): Sends echo request with timeout, returns RTT.
+        ip (str): Device IP.
+        count (int): Echo requests to send before device is considered offline.
+        interval (float): Seconds between echo requests.
+        estimator (RttEstimator): RTT estimator.
+
+    Returns:
+        float | None: RTT of the first answered request. None if all requests were lost.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(count):
+        if attempt:
+            wait = sent + interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        sent = loop.time()
+
+        timeout = estimator.max_timeout if attempt else estimator.timeout(ip)
+        rtt = await echo(ip, timeout)
+        if rtt is not None:
+            estimator.update(ip, rtt)
+            return rtt
+    return None
+
+
+async def subprocess_echo(ip: str, timeout: float) -> float | None:
+    """Send single echo request with system `ping` utility. Used when ICMP socket is not available.
+
+    Args:
+        ip (str): Device IP.
+        timeout (float): Seconds to wait for reply, rounded up to whole seconds.
+
+    Returns:
+        float | None: Time `ping` took. None if reply was not received.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    process = await asyncio.create_subprocess_exec(
+        "ping",
+        "-c",
+        "1",
+        "-W",
+        str(max(1, math.ceil(timeout))),
+        ip,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        await process.communicate()
+    finally:
+        # Probe cancelled at it's deadline must not leave `ping` behind.
+        if process.returncode is None:
+            process.kill()
+    return loop.time() - started if process.returncode == 0 else None
+
+
+async def tcp_echo(ip: str, timeout: float, port: int) -> float | None:
+    """Open TCP connection to camera port and close it right away.
+
+    Args:
+        ip (str): Device IP.
+        timeout (float): Seconds to wait for connection.
+        port (int): Device port, e.g. 554 (RTSP) or 80 (HTTP).
+
+    Returns:
+        float | None: Time to connect. None if connection failed or was not established in time.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = loop.time() - started
+    writer.close()
+    return rtt
+
+
+async def rtsp_echo(ip: str, timeout: float, port: int) -> float | None:
+    """Send RTSP OPTIONS request to camera and wait for RTSP response of any status,
+    so camera is alive even if it requires authorization.
+
+    Args:
+        ip (str): Device IP.
+        timeout (float): Seconds to wait for response, connection included.
+        port (int): RTSP port.
+
+    Returns:
+        float | None: Time to response. None if there was no valid response in time.
+    """
+
+    async def options() -> bytes:
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            writer.write(
+                f"OPTIONS rtsp://{ip}:{port}/ RTSP/1.0\r\n"
+                "CSeq: 1\r\n"
+                "User-Agent: cuba-cameras-integration\r\n\r\n".encode()
+            )
+            return await reader.readline()
+        finally:
+            writer.close()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+        status_line = await asyncio.wait_for(options(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if not status_line.startswith(b"RTSP/"):
+        return None
+    return loop.time() - started
+
+
+class ProbeEngine:
+    """Probes IPs with any backend. ICMP echo is sent from the shared socket, or `ping` is spawned
+    if socket is not available. TCP and RTSP probes connect to the device port.
+    Single request is sent first, the rest of `count` only if it is lost.
+    """
+
+    def __init__(
+        self,
+        count: int,
+        interval: float,
+        min_timeout: float,
+        timeouts: dict[str, float],
+        default_probe: str,
+    ) -> None:
+        """
+        Args:
+            count (int): Requests to send before device is considered offline.
+            interval (float): Seconds between requests.
+            min_timeout (float): Lowest timeout of the first request, seconds.
+            timeouts (dict[str, float]): Highest timeout by backend, seconds.
+            default_probe (str): Probe of devices without own setting.
+        """
+        self.count = count
+        self.interval = interval
+        self.default_probe = default_probe
+        self.prober = IcmpProber()
+        # RTT estimators by backend, every backend has it's own timeout.
+        self.estimators = {
+            backend: RttEstimator(min_timeout, timeout) for backend, timeout in timeouts.items()
+        }
+
+    def open(self) -> None:
+        """Open shared ICMP socket. Fall back to `ping` subprocess if it is not permitted."""
+        try:
+            self.prober.open()
+        except OSError as e:
+            logging.warning(f"ICMP socket is not available, using ping subprocess: {e}")
+
+    def close(self) -> None:
+        self.prober.close()
+
+    def restore(self, ip: str, probe: str | None, rtt: float) -> None:
+        """Seed RTT estimator of IP with RTT known before restart, if it has none yet.
+
+        Args:
+            ip (str): IP.
+            probe (str | None): Probe backend of IP. Defaults to `default_probe`.
+            rtt (float): RTT in seconds.
+        """
+        estimator = self.estimators[parse_probe(probe or self.default_probe)[0]]
+        if ip not in estimator:
+            estimator.update(ip, rtt)
+
+    async def probe(self, ip: str, probe: str | None = None) -> float | None:
+        """Probe IP with given backend.
+
+        Args:
+            ip (str): IP to probe.
+            probe (str | None, optional): Probe backend, e.g. "tcp:80". Defaults to `default_probe`.
+
+        Returns:
+            float | None: RTT of the first answered request. None if all requests were lost.
+        """
+        backend, port = parse_probe(probe or self.default_probe)
+        if backend == "tcp":
+            echo = functools.partial(tcp_echo, port=port)
+        elif backend == "rtsp":
+            echo = functools.partial(rtsp_echo, port=port)
+        else:
+            echo = self.prober.echo if self.prober.is_open else subprocess_echo
+        return await adaptive_ping(
+            echo, ip, self.count, self.interval, self.estimators[backend]
+        )
@@ -0,0 +1,378 @@
+"""
+Here are implemented probe worker processes. Cameras are split between workers by slot, every worker
+runs it's own probe loop and writes results in shared memory vectors indexed by camera slot.
+Main process reads the vectors and publishes results, so nothing is sent between processes per result.
+Only cameras registry changes and edge states are passed to workers, through queues.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import threading
+from array import array
+from time import monotonic, time
+from typing import Callable, Iterable
+
+import config
+from probe import ProbeEngine
+from processes import ProcessRestarter, exit_with_parent
+from registry import CameraRecord
+from scheduler import DeadlineScheduler, ProbeLimiter
+
+
+# Status of camera, that was not pinged because it's edge is unreachable.
+UNREACHABLE = -1
+# Status of camera, which ping was cancelled at it's deadline.
+TIMED_OUT = -2
+
+
+class StatusVector:
+    """Status, RTT and timestamp of the last ping by camera slot, in shared memory.
+    Every slot is written by one worker only. Sequence number of slot is odd while it is written
+    and even after (seqlock), so reader takes slots, which sequence number changed since it's
+    previous read, and retries reading slot until sequence number is the same before and after.
+    """
+
+    def __init__(self, capacity: int, context) -> None:
+        """
+        Args:
+            capacity (int): Camera slots.
+            context (multiprocessing.context.BaseContext): Multiprocessing context.
+        """
+        self.capacity = capacity
+        self.status = context.RawArray("b", capacity)
+        self.rtt = context.RawArray("d", capacity)
+        self.ts = context.RawArray("d", capacity)
+        self.seq = context.RawArray("I", capacity)
+
+    def write(self, slot: int, status: int, rtt: float | None, ts: float) -> None:
+        """Write ping result of camera slot.
+
+        Args:
+            slot (int): Camera slot.
+            status (int): 1 if camera answered, 0 if not, TIMED_OUT if ping was cancelled at it's deadline,
+                UNREACHABLE if it was not pinged.
+            rtt (float | None): RTT in seconds.
+            ts (float): Time of ping, Unix timestamp.
+        """
+        # Sequence number may be left odd by worker killed while writing.
+        self.seq[slot] |= 1
+        self.status[slot] = status
+        self.rtt[slot] = -1.0 if rtt is None else rtt
+        self.ts[slot] = ts
+        self.seq[slot] = (self.seq[slot] + 1) & 0xFFFFFFFF
+
+    def read(self, slot: int, retries: int = 100) -> tuple[int, int, float | None, float] | None:
+        """Get sequence number, status, RTT and timestamp of camera slot, all of the same write.
+
+        Args:
+            slot (int): Camera slot.
+            retries (int, optional): Reads of slot while it is written. Defaults to 100.
+
+        Returns:
+            tuple[int, int, float | None, float] | None: Sequence number, status, RTT and timestamp.
+                None if slot was written all the time.
+        """
+        for _ in range(retries):
+            sequence = self.seq[slot]
+            if sequence & 1:
+                continue
+            status, rtt, ts = self.status[slot], self.rtt[slot], self.ts[slot]
+            if self.seq[slot] == sequence:
+                return sequence, status, None if rtt < 0 else rtt, ts
+        return None
+
+    def sequences(self, size: int) -> array:
+        """Get copy of sequence numbers of the first `size` slots."""
+        sequences = array("I")
+        sequences.frombytes(memoryview(self.seq).cast("B")[: size * sequences.itemsize])
+        return sequences
+
+
+class ProbeWorker:
+    """Probe loop of worker process. Pings it's cameras at their deadlines and writes results in vector."""
+
+    def __init__(self, vector: StatusVector, commands, workers: int) -> None:
+        """
+        Args:
+            vector (StatusVector): Shared results.
+            commands (multiprocessing.Queue): Registry changes and edge states from main process.
+            workers (int): Amount of workers, global probe limits are split between them.
+        """
+        self.vector = vector
+        self.commands = commands
+        self.cameras = {}
+        self.down = set()
+        self.tasks = {}
+        self.scheduler = DeadlineScheduler()
+        self.probes = ProbeEngine(**config.PROBE_SETTINGS)
+        self.limiter = ProbeLimiter(
+            max(1, config.PROBE_MAX_CONCURRENCY // workers), config.PROBE_RATE / workers
+        )
+
+    def apply(self, command: tuple) -> None:
+        """Apply command of main process.
+
+        Args:
+            command (tuple): ("add", [(slot, CameraRecord), ...], {Camera.id: first deadline}),
+                ("remove", [Camera.id, ...]), ("edge", edge, up) or ("rtt", [(ip, probe, RTT), ...]).
+        """
+        kind, *args = command
+        if kind == "add":
+            records, first_due = args
+            for slot, record in records:
+                self.cameras[record.id] = (slot, record)
+                self.scheduler.add(record.id, record.ping_period, first_due.get(record.id))
+        elif kind == "rtt":
+            for ip, probe, rtt in args[0]:
+                self.probes.restore(ip, probe, rtt)
+        elif kind == "remove":
+            for camera_id in args[0]:
+                self.cameras.pop(camera_id, None)
+                self.scheduler.remove(camera_id)
+        elif kind == "edge":
+            edge, up = args
+            if up:
+                self.down.discard(edge)
+            else:
+                self.down.add(edge)
+
+    def _receive(self, loop: asyncio.AbstractEventLoop) -> None:
+        while True:
+            loop.call_soon_threadsafe(self.apply, self.commands.get())
+
+    def dispatch(self, camera_id: str, due: float) -> None:
+        if camera_id in self.cameras and camera_id not in self.tasks:
+            self.tasks[camera_id] = asyncio.create_task(self.probe(camera_id, due))
+            self.tasks[camera_id].add_done_callback(
+                lambda _: self.tasks.pop(camera_id, None)
+            )
+
+    async def _ping(self, record: CameraRecord) -> tuple[float | None, float]:
+        async with self.limiter:
+            ts = time()
+            return await self.probes.probe(record.ip, record.probe), ts
+
+    async def probe(self, camera_id: str, due: float) -> None:
+        """Ping camera and write result. Ping is cancelled at the same deadline as in main process."""
+        slot, record = self.cameras[camera_id]
+        ts = time()
+        if record.edge in self.down:
+            self.vector.write(slot, UNREACHABLE, None, ts)
+            return
+
+        status = TIMED_OUT
+        rtt = None
+        deadline = due + record.ping_period * config.PROBE_DEADLINE
+        try:
+            rtt, ts = await asyncio.wait_for(
+                self._ping(record), max(0.0, deadline - monotonic())
+            )
+            status = int(rtt is not None)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            logging.error(f"Error in getting device {record.name} ({record.ip}) connection: {e}")
+            status = 0
+
+        # Camera could be removed, and it's slot given to another one, while it was pinged.
+        if self.cameras.get(camera_id, (None,))[0] == slot:
+            self.vector.write(slot, status, rtt, ts)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._receive, args=(loop,), daemon=True).start()
+        if config.PROBE_BACKEND == "icmp":
+            self.probes.open()
+        try:
+            await self.scheduler.run(self.dispatch)
+        finally:
+            self.probes.close()
+
+
+def run_probe_worker(vector: StatusVector, commands, workers: int) -> None:
+    """Probe worker process entry."""
+    exit_with_parent()
+    asyncio.run(ProbeWorker(vector, commands, workers).run())
+
+
+class ProbePool:
+    """Runs probe workers and reads their results. Every camera gets a stable slot in vector,
+    cameras of slot `i` are pinged by worker `i % workers`.
+    """
+
+    def __init__(self, workers: int) -> None:
+        """
+        Args:
+            workers (int): Amount of worker processes.
+        """
+        self.workers = workers
+        self.vector = None
+        self._context = multiprocessing.get_context("spawn")
+        self._commands = [None] * workers
+        self._processes = [None] * workers
+        self._restarter = ProcessRestarter("Probe worker {}", self._start_worker)
+        self._down = set()
+        self._slots = {}
+        self._records = []
+        self._free = []
+        # Slots above are never given to cameras yet, so they are not read.
+        self._size = 0
+        self._seen = array("I")
+
+    def start(
+        self,
+        records: Iterable[CameraRecord],
+        capacity: int = 0,
+        first_due: dict | None = None,
+        rtt: dict | None = None,
+    ) -> None:
+        """Give slots to cameras and start workers.
+
+        Args:
+            records (Iterable[CameraRecord]): Cameras.
+            capacity (int, optional): Camera slots. Defaults to twice as many as cameras.
+            first_due (dict | None, optional): Monotonic time of the first ping by Camera.id,
+                see `DeadlineScheduler.add`. Defaults to None.
+            rtt (dict | None, optional): RTT known before restart by Camera.id. Defaults to None.
+        """
+        records = list(records)
+        capacity = capacity or max(2 * len(records), len(records) + 1024)
+        self.vector = StatusVector(capacity, self._context)
+        self._records = [None] * capacity
+        self._free = list(range(capacity - 1, -1, -1))
+        self._seen = array("I", bytes(4 * capacity))
+
+        for record in records:
+            self._assign(record)
+        for index in range(self.workers):
+            self._start_worker(index, first_due, rtt)
+        logging.info(f"Started {self.workers} probe workers with {capacity} camera slots")
+
+    def _assign(self, record: CameraRecord) -> int | None:
+        slot = self._slots.get(record.id)
+        if slot is None:
+            if not self._free:
+                logging.error(f"No free probe slot for camera {record.id}")
+                return None
+            slot = self._free.pop()
+            self._slots[record.id] = slot
+            self._size = max(self._size, slot + 1)
+        self._records[slot] = record
+        return slot
+
+    def _start_worker(
+        self, index: int, first_due: dict | None = None, rtt: dict | None = None
+    ) -> None:
+        first_due = first_due or {}
+        rtt = rtt or {}
+        # Killed worker may hold lock of it's queue, so every worker gets a new one.
+        self._commands[index] = self._context.Queue()
+        process = self._context.Process(
+            target=run_probe_worker,
+            args=(self.vector, self._commands[index], self.workers),
+            name=f"probe-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+        # Worker gets all it's cameras in one command.
+        records = [
+            (slot, record)
+            for slot, record in enumerate(self._records)
+            if record is not None and slot % self.workers == index
+        ]
+        self._commands[index].put(
+            (
+                "add",
+                records,
+                {record.id: first_due[record.id] for _, record in records if record.id in first_due},
+            )
+        )
+        self._commands[index].put(
+            (
+                "rtt",
+                [
+                    (record.ip, record.probe, rtt[record.id])
+                    for _, record in records
+                    if rtt.get(record.id) is not None
+                ],
+            )
+        )
+        for edge in self._down:
+            self._commands[index].put(("edge", edge, False))
+
+    def add(self, record: CameraRecord) -> None:
+        """Add camera, or update camera with the same id."""
+        slot = self._assign(record)
+        if slot is not None:
+            self._commands[slot % self.workers].put(("add", [(slot, record)], {}))
+
+    def remove(self, camera_id: str) -> None:
+        slot = self._slots.pop(camera_id, None)
+        if slot is None:
+            return
+        self._records[slot] = None
+        self._free.append(slot)
+        self._commands[slot % self.workers].put(("remove", [camera_id]))
+
+    def set_edge(self, edge: str, up: bool) -> None:
+        """Pass edge state to all workers. Cameras behind unreachable edge are not pinged."""
+        if up:
+            self._down.discard(edge)
+        else:
+            self._down.add(edge)
+        for commands in self._commands:
+            commands.put(("edge", edge, up))
+
+    def collect(self) -> list[tuple[CameraRecord, int, float | None, float]]:
+        """Get results written since previous call.
+
+        Returns:
+            list[tuple[CameraRecord, int, float | None, float]]: Camera, status, RTT and time of ping.
+        """
+        sequences = self.vector.sequences(self._size)
+        if sequences == self._seen[: self._size]:
+            return []
+
+        results = []
+        for slot, (sequence, seen) in enumerate(zip(sequences, self._seen)):
+            if sequence == seen:
+                continue
+            # Slot may be written again since sequence numbers were copied, so the sequence number
+            # of values read is taken, otherwise they would be taken twice.
+            result = self.vector.read(slot)
+            if result is None:
+                continue
+            self._seen[slot] = result[0]
+            record = self._records[slot]
+            if record is not None:
+                results.append((record, *result[1:]))
+        return results
+
+    async def run(
+        self,
+        on_result: Callable[[CameraRecord, int, float | None, float], None],
+        interval: float = 0.2,
+    ) -> None:
+        """Pass results of workers to callback every `interval` seconds. Works in loop.
+
+        Args:
+            on_result (Callable[[CameraRecord, int, float | None, float], None]): Called with camera,
+                status (1, 0 or UNREACHABLE), RTT and time of ping.
+            interval (float, optional): Seconds between reads. Defaults to 0.2.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self._restarter.check(enumerate(self._processes))
+            for result in self.collect():
+                try:
+                    on_result(*result)
+                except Exception as e:
+                    logging.exception(f"Error while handling ping result: {e}")
+
+    def close(self) -> None:
+        for process in self._processes:
+            if process is not None:
+                process.terminate()
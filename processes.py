@@ -0,0 +1,60 @@
+"""
+Here are implemented helpers shared by child processes of the service: region workers of supervisor
+and probe workers. Only standard library is imported, so region worker can import it before
+it's settings are set up.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from time import time
+from typing import Callable, Hashable, Iterable
+
+
+# Seconds dead process stays dead before it is restarted.
+RESTART_DELAY = 5
+
+
+def exit_with_parent() -> None:
+    """Exit child process together with parent, even if parent was killed without terminating it."""
+    threading.Thread(
+        target=lambda: (multiprocessing.parent_process().join(), os._exit(1)),
+        daemon=True,
+    ).start()
+
+
+class ProcessRestarter:
+    """Restarts child processes that died, after RESTART_DELAY seconds."""
+
+    def __init__(self, name: str, start: Callable[[Hashable], None]) -> None:
+        """
+        Args:
+            name (str): Name of process in log, formatted with it's key, e.g. "Probe worker {}".
+            start (Callable[[Hashable], None]): Starts process by key.
+        """
+        self.name = name
+        self.start = start
+        self._dead_since = {}
+        self._checked = 0.0
+
+    def check(self, processes: Iterable[tuple[Hashable, multiprocessing.Process]]) -> None:
+        """Restart processes that died. Checked once a second.
+
+        Args:
+            processes (Iterable[tuple[Hashable, multiprocessing.Process]]): Processes by key.
+        """
+        if time() - self._checked < 1:
+            return
+        self._checked = time()
+
+        for key, process in list(processes):
+            if process.is_alive():
+                continue
+            dead_since = self._dead_since.setdefault(key, time())
+            if time() - dead_since >= RESTART_DELAY:
+                logging.error(
+                    f"{self.name.format(key)} exited with code {process.exitcode}, restarting"
+                )
+                del self._dead_since[key]
+                self.start(key)
@@ -0,0 +1,193 @@
+"""
+Here is implemented bulk provisioning of cameras. Rows in `list.csv`, `all_cameras.csv`, `edges.csv` or JSON format
+are compared with the registry in one pass, and the difference is applied in a single transaction.
+"""
+
+import csv
+import json
+import logging
+from dataclasses import asdict, dataclass, field, replace
+from typing import Iterable
+
+from database import bulk_sync_cameras
+from probe import parse_probe
+from registry import CameraRecord, CameraRegistry
+
+
+DEFAULT_PING_PERIOD = 60
+
+# Column names of every supported format, by camera field.
+FIELDS = {
+    "id": ("id", "UUID", "uuid"),
+    "name": ("name", "deviceName", "Название"),
+    "ip": ("ip", "IP"),
+    "ping_period": ("ping_period", "Пинг каждые (сек.)"),
+    "edge": ("edge",),
+    "region": ("region",),
+    "group_name": ("group_name", "groupName"),
+    "probe": ("probe",),
+}
+
+
+@dataclass
+class CameraChanges:
+    """Difference between given rows and cameras registry."""
+
+    inserts: list[CameraRecord] = field(default_factory=list)
+    updates: list[CameraRecord] = field(default_factory=list)
+    deletes: list[CameraRecord] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.inserts or self.updates or self.deletes)
+
+    def summary(self) -> dict:
+        return {
+            "inserted": len(self.inserts),
+            "updated": len(self.updates),
+            "deleted": len(self.deletes),
+        }
+
+
+def parse_ping_period(value) -> int:
+    """Get ping period in seconds from RPC or file value.
+
+    Args:
+        value: Whole seconds, number or string.
+
+    Returns:
+        int: Ping period.
+
+    Raises:
+        ValueError: If value is not a positive whole number.
+    """
+    try:
+        ping_period = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid ping period {value!r}") from None
+    if ping_period <= 0:
+        raise ValueError(f"Ping period must be positive, got {value!r}")
+    return ping_period
+
+
+def normalize_row(row: dict) -> dict | None:
+    """Map row of any supported format to camera fields. Rows may be partial,
+    e.g. `edges.csv` rows only set Camera.edge of existing cameras.
+
+    Args:
+        row (dict): Row from CSV or JSON.
+
+    Returns:
+        dict | None: Camera fields present in row. None if row has no id.
+    """
+    camera = {}
+    for name, columns in FIELDS.items():
+        for column in columns:
+            value = row.get(column)
+            if value not in (None, ""):
+                camera[name] = value.strip() if isinstance(value, str) else value
+                break
+
+    if not camera.get("id"):
+        return None
+    if "ping_period" in camera:
+        try:
+            camera["ping_period"] = parse_ping_period(camera["ping_period"])
+        except ValueError as e:
+            logging.warning(f"Ping period of camera {camera['id']} is ignored: {e}")
+            del camera["ping_period"]
+    if "probe" in camera:
+        try:
+            parse_probe(camera["probe"])
+        except ValueError as e:
+            logging.warning(f"Probe of camera {camera['id']} is ignored: {e}")
+            del camera["probe"]
+    return camera
+
+
+def read_rows(path: str) -> list[dict]:
+    """Read cameras from CSV or JSON file.
+
+    Args:
+        path (str): File path. JSON is expected if it ends with ".json".
+
+    Returns:
+        list[dict]: Camera fields of every valid row.
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        if path.endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+
+    cameras = [camera for camera in map(normalize_row, rows) if camera]
+    logging.info(f"Read {len(cameras)} cameras of {len(rows)} rows from {path}")
+    return cameras
+
+
+def diff_cameras(
+    rows: Iterable[dict],
+    registry: CameraRegistry,
+    delete_missing: bool,
+    fields: Iterable[str] | None = None,
+) -> CameraChanges:
+    """Compare rows with registry.
+
+    Args:
+        rows (Iterable[dict]): Normalized camera fields.
+        registry (CameraRegistry): Current cameras.
+        delete_missing (bool): Delete cameras that are not in rows.
+        fields (Iterable[str] | None, optional): Only these fields are taken from rows. Defaults to all.
+
+    Returns:
+        CameraChanges: Cameras to insert, update and delete.
+    """
+    changes = CameraChanges()
+    seen = set()
+
+    if fields is not None:
+        fields = {"id", *fields}
+        rows = ({k: v for k, v in row.items() if k in fields} for row in rows)
+
+    for row in {row["id"]: row for row in rows}.values():
+        seen.add(row["id"])
+        current = registry.get(row["id"])
+        if current is None:
+            # New camera can't be pinged without IP.
+            if row.get("ip"):
+                changes.inserts.append(
+                    CameraRecord(
+                        row["id"],
+                        row.get("name", row["id"]),
+                        row["ip"],
+                        row.get("ping_period", DEFAULT_PING_PERIOD),
+                        row.get("edge"),
+                        row.get("region"),
+                        row.get("group_name"),
+                        row.get("probe"),
+                    )
+                )
+            continue
+
+        updated = replace(current, **{k: v for k, v in row.items() if k != "id"})
+        if updated != current:
+            changes.updates.append(updated)
+
+    if delete_missing:
+        changes.deletes = [record for record in registry if record.id not in seen]
+    return changes
+
+
+def apply_changes(changes: CameraChanges) -> bool:
+    """Save changes to DB in a single transaction.
+
+    Args:
+        changes (CameraChanges): Cameras to insert, update and delete.
+
+    Returns:
+        bool: True if successful. False otherwise.
+    """
+    return bulk_sync_cameras(
+        inserts=[asdict(r) for r in changes.inserts],
+        updates=[asdict(r) for r in changes.updates],
+        deletes=[r.id for r in changes.deletes],
+    )
@@ -0,0 +1,126 @@
+"""
+Here is implemented in-memory cameras registry. It keeps compact camera records indexed by id, name,
+IP, ping period and edge, so scheduler and RPC handlers never have to query database.
+"""
+
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from models import Camera
+
+
+@dataclass(slots=True)
+class CameraRecord:
+    """Compact camera data needed for pinging."""
+
+    id: str
+    name: str
+    ip: str
+    ping_period: int
+    edge: str | None = None
+    region: str | None = None
+    group_name: str | None = None
+    probe: str | None = None
+
+    @classmethod
+    def from_model(cls, camera: Camera) -> "CameraRecord":
+        """Make record of Camera, or of any row with the same attributes."""
+        return cls(
+            camera.id,
+            camera.name,
+            camera.ip,
+            camera.ping_period,
+            camera.edge,
+            camera.region,
+            camera.group_name,
+            camera.probe,
+        )
+
+
+class CameraRegistry:
+    """Cameras indexed by id, name, IP, ping period and edge. All lookups are O(1)."""
+
+    def __init__(self) -> None:
+        self._by_id = {}
+        self._by_name = {}
+        self._by_ip = {}
+        self._by_period = {}
+        self._by_edge = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[CameraRecord]:
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, camera_id: str) -> bool:
+        return camera_id in self._by_id
+
+    def load(self, cameras: Iterable[Camera]) -> None:
+        """Fill registry with cameras from DB.
+
+        Args:
+            cameras (Iterable[Camera]): Cameras, or rows of their columns.
+        """
+        for camera in cameras:
+            self.add(CameraRecord.from_model(camera))
+
+    def add(self, record: CameraRecord) -> None:
+        """Put camera in registry. Camera with same id is replaced.
+
+        Args:
+            record (CameraRecord): Camera.
+        """
+        self.remove(record.id)
+        self._by_id[record.id] = record
+        self._by_name[record.name] = record
+        self._by_ip.setdefault(record.ip, {})[record.id] = record
+        self._by_period.setdefault(record.ping_period, {})[record.id] = record
+        self._by_edge.setdefault(record.edge, {})[record.id] = record
+
+    def remove(self, camera_id: str) -> CameraRecord | None:
+        """Remove camera from registry.
+
+        Args:
+            camera_id (str): Camera.id.
+
+        Returns:
+            CameraRecord | None: Removed camera, None if there was no such.
+        """
+        record = self._by_id.pop(camera_id, None)
+        if record is None:
+            return None
+
+        if self._by_name.get(record.name) is record:
+            del self._by_name[record.name]
+        self._discard(self._by_ip, record.ip, camera_id)
+        self._discard(self._by_period, record.ping_period, camera_id)
+        self._discard(self._by_edge, record.edge, camera_id)
+        return record
+
+    @staticmethod
+    def _discard(index: dict, key, camera_id: str) -> None:
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(camera_id, None)
+            if not bucket:
+                del index[key]
+
+    def get(self, camera_id: str) -> CameraRecord | None:
+        return self._by_id.get(camera_id)
+
+    def by_name(self, name: str) -> CameraRecord | None:
+        return self._by_name.get(name)
+
+    def by_ip(self, ip: str) -> list[CameraRecord]:
+        return list(self._by_ip.get(ip, {}).values())
+
+    def by_period(self, period: int) -> list[CameraRecord]:
+        return list(self._by_period.get(period, {}).values())
+
+    def by_edge(self, edge: str | None) -> list[CameraRecord]:
+        return list(self._by_edge.get(edge, {}).values())
+
+    def periods(self) -> list[int]:
+        """Get ping periods that have at least one camera."""
+        return list(self._by_period.keys())
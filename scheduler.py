@@ -0,0 +1,211 @@
+"""
+Here is implemented probe scheduling. Every camera gets a deterministic phase offset within
+its ping period, so probes are spread evenly over the period instead of being sent at once.
+"""
+
+import asyncio
+import heapq
+import math
+from time import monotonic
+from typing import Callable, Hashable
+
+import mmh3
+
+
+def phase_offset(camera_id: str, period: float) -> float:
+    """Get deterministic offset of camera probe within ping period.
+
+    Args:
+        camera_id (str): Camera.id.
+        period (float): Ping period.
+
+    Returns:
+        float: Offset in seconds, in range [0, period).
+    """
+    return mmh3.hash(camera_id, signed=False) / 2**32 * period
+
+
+def next_deadline(camera_id: str, period: float, now: float) -> float:
+    """Get the first deadline of camera at or after `now`. Deadlines of camera are
+    its phase offset plus whole ping periods, so they never drift.
+
+    Args:
+        camera_id (str): Camera.id.
+        period (float): Ping period.
+        now (float): Monotonic time.
+
+    Returns:
+        float: Monotonic time of the deadline.
+    """
+    offset = phase_offset(camera_id, period)
+    return offset + math.ceil((now - offset) / period) * period
+
+
+class ProbeLimiter:
+    """Caps number of probes in flight and rate at which probes are started."""
+
+    def __init__(self, max_concurrency: int, rate: float) -> None:
+        """
+        Args:
+            max_concurrency (int): Maximum probes running at the same time.
+            rate (float): Maximum probes started per second.
+        """
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._spacing = 1 / rate
+        self._next_slot = 0.0
+
+    async def __aenter__(self) -> "ProbeLimiter":
+        await self._semaphore.acquire()
+
+        # Reserve next free start slot, slots are spaced by 1 / rate seconds.
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._spacing
+        if slot > now:
+            try:
+                await asyncio.sleep(slot - now)
+            except asyncio.CancelledError:
+                # Probe cancelled at it's deadline while waiting for start slot.
+                self._semaphore.release()
+                raise
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._semaphore.release()
+
+
+class DeadlineScheduler:
+    """Keeps next deadline of every camera in a heap, on `time.monotonic()` clock.
+    Single dispatcher fires cameras as they come due and schedules their next deadline
+    one ping period later, regardless of how long the probe takes.
+    """
+
+    def __init__(self, resolution: float = 0.01) -> None:
+        """
+        Args:
+            resolution (float): Cameras due within this many seconds are fired together.
+        """
+        self.resolution = resolution
+        self._heap = []
+        self._entries = {}
+        self._wakeup = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def add(self, key: Hashable, period: float, due: float | None = None) -> None:
+        """Schedule camera, or reschedule it with a new ping period.
+
+        Args:
+            key (Hashable): Camera.id.
+            period (float): Ping period.
+            due (float | None, optional): Monotonic time of the first deadline, camera returns
+                to it's phase offset after it. Defaults to the next deadline at phase offset.
+
+        Raises:
+            ValueError: If ping period is not positive, deadlines of camera would never move on.
+        """
+        if not period > 0:
+            raise ValueError(f"Ping period of {key} must be positive, got {period!r}")
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == period:
+            return
+        if due is None:
+            due = next_deadline(key, period, monotonic())
+        self._push(key, due, period)
+
+        # Wake up dispatcher if the new deadline comes before the one it sleeps till.
+        if self._wakeup is not None and due < self._wakeup[0]:
+            self._wake()
+
+    def remove(self, key: Hashable) -> None:
+        """Unschedule camera. Its heap entry is skipped when it comes due."""
+        self._entries.pop(key, None)
+
+    def deadline(self, key: Hashable) -> float | None:
+        """Get next deadline of camera, None if it is not scheduled."""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def next_due(self) -> float | None:
+        """Get the closest deadline, None if nothing is scheduled."""
+        while self._heap:
+            due, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> list[tuple[Hashable, float]]:
+        """Take cameras with deadline up to `now` and schedule their next deadlines.
+        Deadlines missed entirely (dispatcher was late more than a period) are skipped.
+
+        Args:
+            now (float): Monotonic time.
+
+        Returns:
+            list[tuple[Hashable, float]]: Due cameras with their deadlines.
+        """
+        due_keys = []
+        while self._heap and self._heap[0][0] <= now + self.resolution:
+            due, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != due:
+                continue
+
+            # Next deadline at phase offset a period later at least,
+            # which is exactly a period later unless the first deadline was set explicitly.
+            period = entry[1]
+            following = next_deadline(key, period, due + period - self.resolution)
+            if following <= now:
+                following = next_deadline(key, period, now)
+            self._push(key, following, period)
+            due_keys.append((key, due))
+
+        # Drop entries of removed and rescheduled cameras once they outnumber live ones.
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._heap = [
+                (due, key)
+                for due, key in self._heap
+                if key in self._entries and self._entries[key][0] == due
+            ]
+            heapq.heapify(self._heap)
+        return due_keys
+
+    def _push(self, key: Hashable, due: float, period: float) -> None:
+        self._entries[key] = (due, period)
+        heapq.heappush(self._heap, (due, key))
+
+    def _wake(self) -> None:
+        if self._wakeup is not None and not self._wakeup[1].done():
+            self._wakeup[1].set_result(None)
+
+    async def run(self, dispatch: Callable[[Hashable, float], None]) -> None:
+        """Call `dispatch` with every camera and its deadline as it comes due. Works in loop.
+
+        Args:
+            dispatch (Callable[[Hashable, float], None]): Starts probe of camera, must not block.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            now = monotonic()
+            for key, due in self.pop_due(now):
+                dispatch(key, due)
+
+            # Sleep till the closest deadline, or until an earlier one is added.
+            due = self.next_due()
+            waiter = loop.create_future()
+            self._wakeup = (math.inf if due is None else due, waiter)
+            timer = None
+            if due is not None:
+                timer = loop.call_later(max(0.0, due - monotonic()), self._wake)
+            try:
+                await waiter
+            finally:
+                self._wakeup = None
+                if timer is not None:
+                    timer.cancel()
@@ -0,0 +1,96 @@
+"""
+Here is implemented the local telemetry spool. Telemetry that can't be delivered to broker is appended
+to a bounded SQLite file and replayed in large batches, with original timestamps, once connection is back.
+"""
+
+import json
+import logging
+import sqlite3
+from typing import Callable
+
+from database import configure_connection
+
+
+class TelemetrySpool:
+    """Append-only queue of device telemetry on disk. Oldest rows are dropped when it is full."""
+
+    def __init__(self, path: str, max_rows: int, batch_size: int) -> None:
+        """
+        Args:
+            path (str): SQLite database file.
+            max_rows (int): Rows (device telemetry lists) kept at most.
+            batch_size (int): Rows replayed in one message.
+        """
+        self.path = path
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        configure_connection(self._connection)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS spool "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, device TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._rows = self._connection.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        if self._rows:
+            logging.info(f"Telemetry spool holds {self._rows} rows to replay")
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def append(self, data: dict) -> None:
+        """Spool telemetry message.
+
+        Args:
+            data (dict): Telemetry lists by device name, same as gateway telemetry message.
+        """
+        rows = [(device, json.dumps(telemetry)) for device, telemetry in data.items()]
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT INTO spool (device, data) VALUES (?, ?)", rows)
+            overflow = self._rows + len(rows) - self.max_rows
+            if overflow > 0:
+                connection.execute(
+                    "DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)",
+                    (overflow,),
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        self._rows += len(rows)
+        if overflow > 0:
+            self._rows -= overflow
+            logging.warning(f"Telemetry spool is full, dropped {overflow} oldest rows")
+
+    def replay(self, publish: Callable[[dict], None]) -> int:
+        """Publish the oldest batch of spooled telemetry as one message and remove it from spool.
+        Rows stay in spool if `publish` raises.
+
+        Args:
+            publish (Callable[[dict], None]): Publishes telemetry lists by device name.
+
+        Returns:
+            int: Rows replayed.
+        """
+        rows = self._connection.execute(
+            "SELECT id, device, data FROM spool ORDER BY id LIMIT ?", (self.batch_size,)
+        ).fetchall()
+        if not rows:
+            self._rows = 0
+            return 0
+
+        data = {}
+        for _, device, telemetry in rows:
+            data.setdefault(device, []).extend(json.loads(telemetry))
+        publish(data)
+
+        self._connection.execute("DELETE FROM spool WHERE id <= ?", (rows[-1][0],))
+        self._rows = max(0, self._rows - len(rows))
+        if not self._rows:
+            logging.info("Telemetry spool replayed")
+        return len(rows)
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,115 @@
+"""
+Here is implemented write-behind persistence of ping results. Results are buffered in memory
+and written to database in one transaction at a configured interval, outside of the event loop.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from time import perf_counter
+
+from database import configure_connection
+from metrics import DB_OPERATION_DURATION
+
+
+class ResultStore:
+    """Buffers Camera.last_ping, Camera.online, status state machine and reported state per camera
+    and flushes them in batches."""
+
+    def __init__(self, path: str, flush_interval: float) -> None:
+        """
+        Args:
+            path (str): SQLite database file.
+            flush_interval (float): Seconds between flushes.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        camera_id: str,
+        online: int,
+        ts: datetime,
+        flapping: bool = False,
+        history: int = 0,
+        rtt: float | None = None,
+        reported: int | str | None = None,
+    ) -> None:
+        """Buffer ping result of camera. Only the latest result per camera is kept.
+
+        Args:
+            camera_id (str): Camera.id.
+            online (int): Camera connection status.
+            ts (datetime): Time of ping.
+            flapping (bool, optional): Whether camera is flapping. Defaults to False.
+            history (int, optional): Packed ping history. Defaults to 0.
+            rtt (float | None, optional): RTT in seconds. Last known RTT is kept if None.
+            reported (int | str | None, optional): State last published to platform, see
+                `main.report_status`. Last known state is kept if None.
+        """
+        self._pending[camera_id] = (
+            ts.isoformat(" "),
+            online,
+            int(flapping),
+            history,
+            rtt,
+            None if reported is None else str(reported),
+            camera_id,
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            configure_connection(self._connection)
+        return self._connection
+
+    def _write(self, rows: list[tuple]) -> None:
+        """Write rows in one short transaction. Runs in worker thread."""
+        with self._lock:
+            connection = self._connect()
+            started = perf_counter()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "UPDATE cameras SET last_ping = ?, online = ?, flapping = ?, history = ?, "
+                    "rtt = COALESCE(?, rtt), reported = COALESCE(?, reported) WHERE id = ?",
+                    rows,
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            DB_OPERATION_DURATION.observe(perf_counter() - started, operation="store_results")
+
+    async def flush(self) -> None:
+        """Write all buffered results to database without blocking event loop."""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, list(pending.values()))
+        except Exception as e:
+            logging.error(f"Error while storing {len(pending)} ping results: {e}")
+            # Put results back unless newer ones arrived meanwhile.
+            for camera_id, row in pending.items():
+                self._pending.setdefault(camera_id, row)
+
+    async def run(self) -> None:
+        """Flush buffered results every `flush_interval` seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
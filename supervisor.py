@@ -0,0 +1,474 @@
+"""
+Supervisor mode entry point. Starts one worker process per region DB, every worker runs it's own
+event loop over it's own cameras. All workers publish through the single gateway owned by supervisor.
+
+Usage:
+    python supervisor.py [dbs/karaganda.sqlite dbs/temirtau.sqlite ...]
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from glob import glob
+from time import time
+
+from tb_gateway_mqtt import GATEWAY_MAIN_TOPIC, TBGatewayMqttClient
+
+# Spawned worker imports this module again before it runs `run_worker`, and project modules read
+# settings from environment on import (DB engine is created on import of `database`). So they are
+# imported only inside functions, after worker has set up environment of it's region.
+# `processes` imports nothing but standard library.
+from processes import ProcessRestarter, exit_with_parent
+
+
+# Seconds to wait for replies of all workers to RPC that is fanned out, in every step.
+FAN_OUT_TIMEOUT = 60
+# Seconds late replies of workers to RPC's that timed out are dropped for.
+LATE_REPLIES_KEPT = 10 * FAN_OUT_TIMEOUT
+
+
+class QueueGateway:
+    """Stand-in for TBGatewayMqttClient inside worker process.
+    Publishes are forwarded to supervisor, RPC's are received from it.
+    """
+
+    def __init__(self, region: str, outbox, inbox) -> None:
+        """
+        Args:
+            region (str): Region of worker.
+            outbox (multiprocessing.Queue): Messages to supervisor.
+            inbox (multiprocessing.Queue): RPC's from supervisor.
+        """
+        self.region = region
+        self._outbox = outbox
+        self._inbox = inbox
+        self._rpc_handler = None
+        self._rpc_handler_set = threading.Event()
+
+    def connect(self) -> None:
+        """Start thread that passes RPC's to handler, same way MQTT client thread does.
+        RPC's received before handler is set wait in inbox.
+        """
+        threading.Thread(target=self._receive_rpcs, daemon=True).start()
+
+    def is_connected(self) -> bool:
+        return True
+
+    def _receive_rpcs(self) -> None:
+        self._rpc_handler_set.wait()
+        while True:
+            self._rpc_handler(self, self._inbox.get())
+
+    def gw_set_server_side_rpc_request_handler(self, handler) -> None:
+        self._rpc_handler = handler
+        self._rpc_handler_set.set()
+
+    def publish_data(self, data: dict, topic: str, qos: int) -> None:
+        self._outbox.put(("publish", data, topic, qos))
+
+    def gw_send_telemetry(self, device: str, telemetry, quality_of_service: int = 1) -> None:
+        if not isinstance(telemetry, list):
+            telemetry = [telemetry]
+        self.publish_data({device: telemetry}, "v1/gateway/telemetry", quality_of_service)
+
+    def gw_connect_device(self, device_name: str, device_type: str = "default") -> None:
+        self._outbox.put(("connect", self.region, device_name, device_type))
+
+    def gw_disconnect_device(self, device_name: str) -> None:
+        self._outbox.put(("disconnect", self.region, device_name))
+
+    def gw_send_rpc_reply(self, device: str, req_id, resp, quality_of_service=None) -> None:
+        self._outbox.put(("rpc_reply", device, req_id, resp))
+
+
+def run_worker(
+    region: str,
+    db_path: str,
+    outbox,
+    inbox,
+    metrics_port: int = 0,
+    totals_device: str | None = None,
+) -> None:
+    """Worker process entry. Runs main loop over cameras of region DB.
+
+    Args:
+        region (str): Region name.
+        db_path (str): Region DB.
+        outbox (multiprocessing.Queue): Messages to supervisor.
+        inbox (multiprocessing.Queue): RPC's from supervisor.
+        metrics_port (int, optional): Port to serve metrics of worker on. Defaults to 0 (disabled).
+        totals_device (str | None, optional): Device totals of region are sent to. Defaults to None.
+    """
+    exit_with_parent()
+
+    # Settings have to be set before any project module is imported, see module imports.
+    os.environ["DB_PATH"] = db_path
+    os.environ["SPOOL_PATH"] = f"spool-{region}.sqlite"
+    os.environ["HISTORY_PATH"] = f"history-{region}"
+    import main
+
+    asyncio.run(
+        main.main(QueueGateway(region, outbox, inbox), metrics_port, totals_device)
+    )
+
+
+class Supervisor:
+    """Runs region workers and publishes their messages through the shared gateway."""
+
+    def __init__(self, db_paths: list[str]) -> None:
+        self.regions = {
+            os.path.splitext(os.path.basename(path))[0]: path for path in db_paths
+        }
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes = {region: self._context.Queue() for region in self.regions}
+        self._workers = {}
+        self._restarter = ProcessRestarter("Worker of region {}", self.start_worker)
+        self._owners = {}
+        self._replayed = 0.0
+        # Last totals of every region: timestamp, total and online cameras, by suffix of totals
+        # device, see `totals_key`.
+        self._totals = {}
+        # Connected devices of totals of all regions by region, edge and group.
+        self._totals_devices = set()
+        # RPC's fanned out to workers, waiting for their replies, by device and request id.
+        # Request ids are unique per device only.
+        self._fan_outs = {}
+        # Replies still expected to RPC's that timed out, and time they timed out, by the same key.
+        self._timed_out = {}
+        self.gateway = None
+        self.spool = None
+
+    def start_worker(self, region: str) -> None:
+        import config
+
+        # Every worker serves metrics on it's own port, starting from METRICS_PORT.
+        metrics_port = config.METRICS_PORT and config.METRICS_PORT + list(self.regions).index(region)
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                region,
+                self.regions[region],
+                self._outbox,
+                self._inboxes[region],
+                metrics_port,
+                self.totals_device(region),
+            ),
+            name=f"worker-{region}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[region] = process
+        logging.info(f"Started worker of region {region} (pid {process.pid})")
+
+    @staticmethod
+    def totals_device(region: str) -> str:
+        """Get device overall totals of region are sent to by it's worker."""
+        import config
+
+        return f"{config.TB_TOTALS_DEVICE_NAME} {region}"
+
+    def totals_key(self, device: str) -> tuple[str, str] | None:
+        """Get region and totals of device, that region worker sends totals to.
+
+        Args:
+            device (str): Device name, e.g. "CAMERAS_TOTALS saran edge 10.1.0.1".
+
+        Returns:
+            tuple[str, str] | None: Region and suffix of device name, "" for overall totals
+                or e.g. " edge 10.1.0.1". None if device is not totals device of region.
+        """
+        import config
+        from totals import DIMENSIONS
+
+        name = device[len(config.TB_TOTALS_DEVICE_NAME) + 1 :]
+        for region in self.regions:
+            if name == region:
+                return region, ""
+            if name.startswith(region + " ") and name[len(region) + 1 :].split(" ")[0] in DIMENSIONS:
+                return region, name[len(region) :]
+        return None
+
+    def add_totals(self, data: dict) -> None:
+        """Add totals of all regions to telemetry, if it holds newer totals of some region.
+        Every worker counts only it's own cameras, so supervisor sums up overall totals, and totals
+        by region, edge and group, of all workers. They are sent to the same devices, that
+        the service sends totals to without supervisor.
+
+        Args:
+            data (dict): Telemetry by device name, changed in place.
+        """
+        import config
+
+        changed = set()
+        prefix = config.TB_TOTALS_DEVICE_NAME + " "
+        for device in [device for device in data if device.startswith(prefix)]:
+            key = self.totals_key(device)
+            if key is None:
+                continue
+            region, suffix = key
+            totals = self._totals.setdefault(suffix, {})
+            for entry in data[device]:
+                values = entry.get("values", {})
+                # Telemetry replayed from spool of worker is older than the last one.
+                if "total devices" in values and entry["ts"] > totals.get(region, (0,))[0]:
+                    totals[region] = (entry["ts"], values["total devices"], values["active devices"])
+                    changed.add(suffix)
+
+        for suffix in changed:
+            device = config.TB_TOTALS_DEVICE_NAME + suffix
+            if suffix and device not in self._totals_devices:
+                self.gateway.gw_connect_device(device, "default")
+                self._totals_devices.add(device)
+            totals = self._totals[suffix].values()
+            total = sum(counts[1] for counts in totals)
+            online = sum(counts[2] for counts in totals)
+            data.setdefault(device, []).append(
+                {
+                    "ts": max(counts[0] for counts in totals),
+                    "values": {
+                        "total devices": total,
+                        "active devices": online,
+                        "inactive devices": total - online,
+                    },
+                }
+            )
+
+    def handle_rpc(self, gateway: TBGatewayMqttClient, request_body: dict) -> None:
+        """Callback for RPC's from platform. It is called from MQTT thread, so RPC is only
+        handed over to the main loop, see `route_rpc`.
+        """
+        self._outbox.put(("rpc", request_body))
+
+    def route_rpc(self, request_body: dict) -> None:
+        """Pass RPC to worker of region that owns the device. Bulk changes of devices go to all
+        workers, and new devices of them to `params.region`, or to the first region. Uptime
+        is reported by all workers, unless device or region is given.
+
+        Args:
+            request_body (dict): Request body.
+        """
+        data = request_body["data"]
+        params = data.get("params") or {}
+        name = params.get("name") if isinstance(params, dict) else None
+        region = params.get("region") if isinstance(params, dict) else None
+        if region not in self._inboxes:
+            region = None
+        if data.get("method") in ("add_devices", "sync_devices") and len(self._inboxes) > 1:
+            self.fan_out(request_body, region or next(iter(self._inboxes)))
+            return
+
+        region = self._owners.get(request_body["device"]) or self._owners.get(name) or region
+        if data.get("method") == "get_uptime" and region is None and len(self._inboxes) > 1:
+            self.fan_out(request_body)
+            return
+        self._inboxes[region or next(iter(self._inboxes))].put(request_body)
+
+    def fan_out(self, request_body: dict, target: str | None = None) -> None:
+        """Pass RPC to all workers and merge their replies, see `merge_replies`.
+
+        Bulk changes of devices are executed in two steps, so every camera stays in one region.
+        First every region except `target` applies rows of cameras it has ("claimed_only")
+        and replies with their indexes. Then `target` gets the rest of rows, it inserts new
+        cameras. "sync_devices" deletes cameras, that are not in the list, in every region.
+
+        Args:
+            request_body (dict): Request body.
+            target (str | None, optional): Region of new devices. Defaults to None, RPC is
+                executed by all workers at once.
+        """
+        data = request_body["data"]
+        regions = [region for region in self._inboxes if region != target]
+        self._fan_outs[(request_body["device"], str(data["id"]))] = {
+            "request": request_body,
+            "target": target,
+            "waiting": len(regions),
+            "replies": [],
+            "started": time(),
+        }
+        params = dict(data["params"], claimed_only=True) if target is not None else data["params"]
+        for region in regions:
+            self._inboxes[region].put({**request_body, "data": {**data, "params": params}})
+
+    def collect_reply(self, device: str, request_id: str, reply) -> None:
+        """Take reply of worker to RPC that was fanned out. Reply to platform,
+        or pass rows nobody claimed to target region, when all workers replied.
+        """
+        fan_out = self._fan_outs[(device, request_id)]
+        fan_out["replies"].append(reply)
+        fan_out["waiting"] -= 1
+        if fan_out["waiting"] > 0:
+            return
+
+        request_body = fan_out["request"]
+        data = request_body["data"]
+        target, fan_out["target"] = fan_out["target"], None
+        # Rows of cameras that region failed to update are not claimed, so they must not be inserted.
+        if target is not None and all(fan_out["replies"]):
+            claimed = {index for reply in fan_out["replies"] for index in reply["claimed"]}
+            devices = [
+                row for index, row in enumerate(data["params"]["devices"]) if index not in claimed
+            ]
+            fan_out["waiting"] = 1
+            fan_out["started"] = time()
+            self._inboxes[target].put(
+                {**request_body, "data": {**data, "params": {**data["params"], "devices": devices}}}
+            )
+            return
+
+        del self._fan_outs[(device, request_id)]
+        self.gateway.gw_send_rpc_reply(
+            device, request_id, self.merge_replies(data["method"], fan_out["replies"])
+        )
+
+    @staticmethod
+    def merge_replies(method: str, replies: list):
+        """Merge replies of workers: sum up changed devices, or merge availability reports.
+        Reply is False if any worker failed.
+        """
+        from history import merge_reports
+
+        if not replies or not all(replies):
+            return False
+        if method == "get_uptime":
+            return merge_reports(replies)
+        return {
+            key: sum(reply[key] for reply in replies)
+            for key in ("inserted", "updated", "deleted")
+        }
+
+    def expire_fan_outs(self) -> None:
+        """Reply "unsuccessful" to RPC's, that some worker didn't reply to within FAN_OUT_TIMEOUT.
+        Replies that workers send later are dropped, see `drop_late_reply`.
+        """
+        for key, fan_out in list(self._fan_outs.items()):
+            if time() - fan_out["started"] >= FAN_OUT_TIMEOUT:
+                device, request_id = key
+                logging.error(f"RPC {request_id} of {device} is not replied by all region workers in time")
+                del self._fan_outs[key]
+                self._timed_out[key] = (fan_out["waiting"], time())
+                self.gateway.gw_send_rpc_reply(device, request_id, False)
+        for key, (_, timed_out) in list(self._timed_out.items()):
+            if time() - timed_out >= LATE_REPLIES_KEPT:
+                del self._timed_out[key]
+
+    def drop_late_reply(self, device: str, request_id: str) -> bool:
+        """Check if reply of worker is to RPC that timed out. Platform got it's reply already.
+
+        Returns:
+            bool: Reply is late and must be dropped.
+        """
+        key = (device, request_id)
+        if key not in self._timed_out:
+            return False
+        waiting, timed_out = self._timed_out[key]
+        if waiting > 1:
+            self._timed_out[key] = (waiting - 1, timed_out)
+        else:
+            del self._timed_out[key]
+        logging.warning(f"Late reply of region worker to RPC {request_id} of {device} is dropped")
+        return True
+
+    def dispatch(self, message: tuple) -> None:
+        """Execute message of worker on gateway."""
+        from telemetry import is_connected
+
+        kind, *args = message
+        if kind == "publish":
+            data, topic, qos = args
+            if topic == GATEWAY_MAIN_TOPIC + "telemetry":
+                self.add_totals(data)
+            # Telemetry is spooled while broker is not reachable.
+            if topic == GATEWAY_MAIN_TOPIC + "telemetry" and not is_connected(self.gateway):
+                self.spool.append(data)
+            else:
+                self.gateway.publish_data(data, topic, qos)
+        elif kind == "connect":
+            region, device_name, device_type = args
+            self._owners[device_name] = region
+            self.gateway.gw_connect_device(device_name, device_type)
+        elif kind == "disconnect":
+            region, device_name = args
+            if self._owners.get(device_name) == region:
+                del self._owners[device_name]
+            self.gateway.gw_disconnect_device(device_name)
+        elif kind == "rpc":
+            self.route_rpc(*args)
+        elif kind == "rpc_reply":
+            device, request_id, _ = args
+            if (device, request_id) in self._fan_outs:
+                self.collect_reply(*args)
+            elif not self.drop_late_reply(device, request_id):
+                self.gateway.gw_send_rpc_reply(*args)
+
+    def replay_spool(self) -> None:
+        """Replay one batch of spooled telemetry, no more often than SPOOL_REPLAY_RATE per second."""
+        import config
+        from telemetry import is_connected
+
+        if time() - self._replayed < 1 / config.SPOOL_REPLAY_RATE:
+            return
+        self._replayed = time()
+
+        if len(self.spool) and is_connected(self.gateway):
+            try:
+                self.spool.replay(
+                    lambda data: self.gateway.publish_data(
+                        data, GATEWAY_MAIN_TOPIC + "telemetry", 1
+                    )
+                )
+            except Exception as e:
+                logging.error(f"Error while replaying spooled telemetry: {e}")
+
+    def run(self) -> None:
+        import config
+        from spool import TelemetrySpool
+
+        self.gateway = TBGatewayMqttClient(
+            config.CUBA_URL,
+            1883,
+            config.TB_GATEWAY_TOKEN,
+            client_id=config.TB_CLIENT_ID,
+        )
+        self.gateway.connect()
+        self.gateway.gw_set_server_side_rpc_request_handler(self.handle_rpc)
+        self.spool = TelemetrySpool(
+            config.SPOOL_PATH, config.SPOOL_MAX_ROWS, config.SPOOL_REPLAY_BATCH
+        )
+        logging.info(f"Gateway connected on {config.CUBA_URL}")
+
+        # Totals of all regions are sent by supervisor, see `add_totals`.
+        self.gateway.gw_connect_device(config.TB_TOTALS_DEVICE_NAME, "default")
+        for region in self.regions:
+            self.start_worker(region)
+
+        try:
+            while True:
+                try:
+                    self.dispatch(self._outbox.get(timeout=1))
+                except queue.Empty:
+                    pass
+                except Exception as e:
+                    logging.exception(f"Error while dispatching worker message: {e}")
+                self._restarter.check(self._workers.items())
+                self.expire_fan_outs()
+                self.replay_spool()
+        finally:
+            for process in self._workers.values():
+                process.terminate()
+            for device in [config.TB_TOTALS_DEVICE_NAME, *self._totals_devices]:
+                self.gateway.gw_disconnect_device(device)
+            self.gateway.disconnect()
+            self.spool.close()
+
+
+if __name__ == "__main__":
+    import config
+
+    Supervisor(
+        sys.argv[1:] or config.REGIONS or sorted(glob("dbs/*.sqlite"))
+    ).run()
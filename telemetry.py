@@ -0,0 +1,186 @@
+"""
+Here is implemented telemetry batching. Telemetry of many devices is collected and sent to platform
+as one gateway message, keyed by device name.
+"""
+
+import asyncio
+import logging
+
+from tb_gateway_mqtt import GATEWAY_MAIN_TOPIC, TBGatewayMqttClient
+
+import config
+from spool import TelemetrySpool
+
+
+def should_report(device: str, status: int) -> bool:
+    """Decide if device status has to be published. In report-by-exception mode status is
+    published only when it differs from the last sent one, or as heartbeat every
+    `config.TELEMETRY_HEARTBEAT_CYCLES` cycles.
+
+    Args:
+        device (str): Device name.
+        status (int): Current device status.
+
+    Returns:
+        bool: True if status has to be published.
+    """
+    if not config.REPORT_BY_EXCEPTION:
+        return True
+
+    last = config.cameras_reported.get(device)
+    if (
+        last is None
+        or last[0] != status
+        or last[1] + 1 >= config.TELEMETRY_HEARTBEAT_CYCLES
+    ):
+        config.cameras_reported[device] = (status, 0)
+        return True
+
+    config.cameras_reported[device] = (status, last[1] + 1)
+    return False
+
+
+def restore_reported(device: str, status) -> None:
+    """Take status as already published, e.g. status persisted before restart,
+    so it is not published again until it changes or heartbeat is due.
+
+    Args:
+        device (str): Device name.
+        status: Device status, same as passed to `should_report`.
+    """
+    config.cameras_reported[device] = (status, 0)
+
+
+def is_connected(gateway: TBGatewayMqttClient) -> bool:
+    """Check connection of gateway. MQTT client state is used, because gateway
+    keeps reporting connected after connection is lost.
+    """
+    client = getattr(gateway, "_client", None)
+    if client is not None:
+        return client.is_connected()
+    return gateway.is_connected()
+
+
+def pending_publishes(gateway: TBGatewayMqttClient) -> int:
+    """Get amount of messages not yet delivered to broker (QoS 1 messages wait for
+    acknowledgement), or not yet taken by supervisor in region worker.
+    """
+    client = getattr(gateway, "_client", None)
+    if client is not None:
+        return len(client._out_messages)
+    outbox = getattr(gateway, "_outbox", None)
+    return outbox.qsize() if outbox is not None else 0
+
+
+class TelemetryAggregator:
+    """Collects devices telemetry and publishes it in combined gateway messages.
+
+    Buffer is flushed when it holds `max_devices` devices or `flush_interval` seconds
+    after the first telemetry was buffered, whichever comes first.
+
+    While gateway is disconnected, or more than `max_pending` messages wait for delivery,
+    telemetry is put in spool instead, and replayed when gateway catches up.
+    """
+
+    def __init__(
+        self,
+        max_devices: int,
+        flush_interval: float,
+        spool: TelemetrySpool | None = None,
+        max_pending: int = 0,
+    ) -> None:
+        """
+        Args:
+            max_devices (int): Devices in one message.
+            flush_interval (float): Seconds telemetry may wait in buffer.
+            spool (TelemetrySpool | None, optional): Spool for undelivered telemetry. Defaults to None.
+            max_pending (int, optional): Undelivered messages, after which telemetry is spooled.
+                Defaults to 0 (unlimited).
+        """
+        self.max_devices = max_devices
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.max_pending = max_pending
+        self.gateway = None
+        self._buffer = {}
+        self._timer = None
+
+    def start(self, gateway: TBGatewayMqttClient) -> None:
+        """Set gateway to publish telemetry to.
+
+        Args:
+            gateway (TBGatewayMqttClient): Gateway.
+        """
+        self.gateway = gateway
+
+    def add(self, device: str, data: list | dict) -> None:
+        """Put device telemetry in buffer. Must be called from event loop thread.
+
+        Args:
+            device (str): Device name.
+            data (list | dict): Telemetry in gateway format, {"ts": ..., "values": ...} or list of them.
+        """
+        if not isinstance(data, list):
+            data = [data]
+        self._buffer.setdefault(device, []).extend(data)
+
+        if len(self._buffer) >= self.max_devices:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self.flush
+            )
+
+    def flush(self) -> None:
+        """Publish all buffered telemetry in one message."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+
+        buffer, self._buffer = self._buffer, {}
+        if self._should_spool():
+            self._spool(buffer)
+            return
+        try:
+            self.publish(buffer)
+        except Exception as e:
+            logging.error(f"Error while sending telemetry of {len(buffer)} devices: {e}")
+            self._spool(buffer)
+
+    def publish(self, data: dict) -> None:
+        self.gateway.publish_data(data, GATEWAY_MAIN_TOPIC + "telemetry", 1)
+
+    def _should_spool(self) -> bool:
+        if self.spool is None:
+            return False
+        if not is_connected(self.gateway):
+            return True
+        return bool(self.max_pending) and pending_publishes(self.gateway) > self.max_pending
+
+    def _spool(self, buffer: dict) -> None:
+        if self.spool is None:
+            return
+        try:
+            self.spool.append(buffer)
+        except Exception as e:
+            logging.error(f"Error while spooling telemetry of {len(buffer)} devices: {e}")
+
+    async def replay(self, rate: float) -> None:
+        """Replay spooled telemetry, no more than `rate` messages per second,
+        while gateway is connected and keeps up. Works in loop.
+
+        Args:
+            rate (float): Replayed messages per second.
+        """
+        if self.spool is None:
+            return
+        while True:
+            replayed = 0
+            if len(self.spool) and not self._should_spool():
+                try:
+                    replayed = self.spool.replay(self.publish)
+                except Exception as e:
+                    logging.error(f"Error while replaying spooled telemetry: {e}")
+            await asyncio.sleep(1 / rate if replayed else 1)
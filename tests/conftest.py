@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# Modules of the service are imported from the repository root, the same way they import each other.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,221 @@
+import random
+import threading
+
+import numpy as np
+import pytest
+
+from history import DAY, ProbeHistory, availability, combine, merge_reports, summarize
+from registry import CameraRecord
+
+
+def naive_totals(results: list[tuple[int, float, int]], size: int) -> dict:
+    """Reference availability per slot over results in order of time."""
+    totals = {name: [0] * size for name in ("samples", "up", "outages", "repairs")}
+    totals["repair_time"] = [0.0] * size
+    down_since = [None] * size
+    for slot, ts, status in results:
+        totals["samples"][slot] += 1
+        totals["up"][slot] += status
+        if not status and down_since[slot] is None:
+            down_since[slot] = ts
+            totals["outages"][slot] += 1
+        elif status and down_since[slot] is not None:
+            totals["repairs"][slot] += 1
+            totals["repair_time"][slot] += ts - down_since[slot]
+            down_since[slot] = None
+    return totals
+
+
+def random_results(rng: random.Random, size: int, count: int, start: float = 0.0) -> list:
+    results = []
+    ts = start
+    up_share = [rng.random() for _ in range(size)]
+    for _ in range(count):
+        ts += rng.random()
+        slot = rng.randrange(size)
+        results.append((slot, ts, int(rng.random() < up_share[slot])))
+    return results
+
+
+def columns(results: list) -> tuple:
+    slot = np.array([r[0] for r in results], np.uint32)
+    ts = np.array([r[1] for r in results], np.float64)
+    status = np.array([r[2] for r in results], np.int8)
+    return slot, ts, status
+
+
+def assert_totals_equal(totals: dict, expected: dict) -> None:
+    for name in ("samples", "up", "outages", "repairs"):
+        assert totals[name].tolist() == expected[name], name
+    np.testing.assert_allclose(totals["repair_time"], expected["repair_time"])
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_combined_summaries_match_naive_totals(seed):
+    rng = random.Random(seed)
+    size = rng.randint(1, 8)
+    results = random_results(rng, size, rng.randint(0, 400))
+
+    # Split results in periods at random borders, some of them empty.
+    borders = sorted(rng.randint(0, len(results)) for _ in range(rng.randint(0, 6)))
+    parts = [results[a:b] for a, b in zip([0] + borders, borders + [len(results)])]
+    summaries = [summarize(*columns(part), size) for part in parts]
+
+    assert_totals_equal(combine(summaries, size), naive_totals(results, size))
+
+
+def test_combine_grows_summaries_of_fewer_slots():
+    early = summarize(*columns([(0, 1.0, 0)]), 1)
+    late = summarize(*columns([(0, 2.0, 1), (1, 3.0, 0), (1, 4.0, 1)]), 2)
+    totals = combine([early, late], 2)
+    assert totals["repairs"].tolist() == [1, 1]
+    assert totals["repair_time"].tolist() == [1.0, 1.0]
+
+
+def test_availability_sums_selected_slots():
+    results = [(0, 1.0, 1), (0, 2.0, 0), (0, 5.0, 1), (1, 1.5, 1), (2, 1.0, 0)]
+    totals = combine([summarize(*columns(results), 3)], 3)
+    assert availability(totals, np.array([0, 1])) == {
+        "uptime": 75.0,
+        "outages": 1,
+        "mttr": 3.0,
+        "cameras": 2,
+        "samples": 4,
+        "repairs": 1,
+    }
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_query_over_segments_matches_naive_totals(tmp_path, seed):
+    rng = random.Random(seed)
+    size = rng.randint(1, 6)
+    # Three closed days, so whole days are summarized from cache on the second query.
+    start = (int(1.7e9) // DAY) * DAY
+    results = []
+    for day in range(3):
+        results += random_results(rng, size, 300, start + day * DAY + rng.random() * 1000)
+        results[-1] = (results[-1][0], start + day * DAY + DAY - 1, results[-1][2])
+
+    history = ProbeHistory(str(tmp_path), retention_days=100000)
+    for slot, ts, status in results:
+        history.append(str(slot), ts, status, None)
+    history.flush()
+    slots = [history.slot(str(slot)) for slot in range(size)]
+
+    query_start = start + rng.random() * DAY
+    query_end = start + 2 * DAY + rng.random() * DAY
+    selected = [
+        (slots[slot], ts, status)
+        for slot, ts, status in results
+        if query_start <= ts < query_end and str(slot) in history._slots
+    ]
+    expected = naive_totals(selected, len(history))
+    assert_totals_equal(history.query(query_start, query_end), expected)
+    assert_totals_equal(history.query(query_start, query_end), expected)
+
+    whole = [(slots[s], ts, status) for s, ts, status in results]
+    assert_totals_equal(history.query(start, start + 3 * DAY), naive_totals(whole, len(history)))
+    assert_totals_equal(history.query(start, start + 3 * DAY), naive_totals(whole, len(history)))
+
+
+def test_report_groups_cameras(tmp_path):
+    history = ProbeHistory(str(tmp_path), retention_days=100000)
+    for ts, statuses in enumerate([(1, 1, 0), (1, 0, 0), (1, 1, 1)]):
+        for camera_id, status in zip("abc", statuses):
+            history.append(camera_id, 1.7e9 + ts, status, None)
+    history.flush()
+    records = [
+        CameraRecord("a", "A", "10.0.0.1", 60, region="north"),
+        CameraRecord("b", "B", "10.0.0.2", 60, region="north"),
+        CameraRecord("c", "C", "10.0.0.3", 60, region="south"),
+    ]
+
+    report = history.report(records, 1.7e9, 1.7e9 + 10, by="region")
+    assert list(report) == ["north", "south"]
+    assert report["north"]["uptime"] == pytest.approx(100 * 5 / 6, abs=1e-3)
+    assert report["south"]["outages"] == 1
+    assert list(history.report(records, 1.7e9, 1.7e9 + 10, by="camera", name="B")) == ["B"]
+    with pytest.raises(ValueError):
+        history.report(records, 1.7e9, 1.7e9 + 10, by="ip")
+
+
+def test_merge_reports_weights_by_results_and_repairs():
+    north = {"all": {"uptime": 50.0, "outages": 2, "mttr": 10.0, "cameras": 1, "samples": 4, "repairs": 1}}
+    south = {
+        "all": {"uptime": 100.0, "outages": 1, "mttr": 40.0, "cameras": 2, "samples": 12, "repairs": 3},
+        "camera": {"uptime": None, "outages": 0, "mttr": None, "cameras": 0, "samples": 0, "repairs": 0},
+    }
+    merged = merge_reports([north, south])
+    assert merged["all"] == {
+        "uptime": 87.5,
+        "outages": 3,
+        "mttr": 32.5,
+        "cameras": 3,
+        "samples": 16,
+        "repairs": 4,
+    }
+    assert merged["camera"]["uptime"] is None
+
+
+def test_only_one_process_writes_history(tmp_path):
+    writer = ProbeHistory(str(tmp_path), retention_days=100000)
+    writer.append("a", 1.7e9, 1, 0.01)
+    assert writer.flush() == 1
+
+    # Lock is held by open file, so another writer is refused even in the same process.
+    other = ProbeHistory(str(tmp_path), retention_days=100000)
+    with pytest.raises(RuntimeError):
+        other.flush()
+    assert other.query(1.7e9, 1.7e9 + 1)["samples"].tolist() == [1]
+
+
+def test_summary_cache_is_written_by_threads_at_once(tmp_path):
+    history = ProbeHistory(str(tmp_path), retention_days=100000)
+    start = (int(1.7e9) // DAY) * DAY
+    for ts in range(0, DAY, 60):
+        history.append(str(ts % 7), start + ts, ts % 3 != 0, None)
+    history.flush()
+    expected = history.summary(start // DAY)
+
+    threads = [
+        threading.Thread(target=lambda: [history.summary(start // DAY) for _ in range(5)])
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not [name for name in tmp_path.iterdir() if name.suffix == ".tmp"]
+    cached = history.summary(start // DAY)
+    assert cached.keys() == expected.keys()
+    for name in expected:
+        np.testing.assert_array_equal(cached[name], expected[name])
+
+
+def test_results_appended_while_flushed_in_thread_keep_columns_aligned(tmp_path):
+    history = ProbeHistory(str(tmp_path), retention_days=100000)
+    flushing = threading.Event()
+
+    def flush():
+        while not flushing.is_set():
+            history.flush()
+
+    thread = threading.Thread(target=flush)
+    thread.start()
+    try:
+        for ts in range(20000):
+            history.append(str(ts % 50), 1.7e9 + ts, ts % 2, ts / 1000)
+    finally:
+        flushing.set()
+        thread.join()
+    history.flush()
+
+    days = history.days()
+    total = sum(len(history.read(day)["ts"]) for day in days)
+    assert total == 20000
+    for day in days:
+        columns = history.read(day)
+        rtt = np.asarray(columns["rtt"])
+        ts = np.asarray(columns["ts"]) - 1.7e9
+        assert np.allclose(rtt, ts / 1000)
+        assert (np.asarray(columns["slot"]) == [history.slot(str(int(t) % 50)) for t in ts]).all()
@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from hysteresis import UNKNOWN, StatusFilter
+
+
+class NaiveFilter:
+    """Reference state machine over plain list of results."""
+
+    def __init__(self, down_after: int, up_after: int, window: int, flap_transitions: int) -> None:
+        self.down_after = down_after
+        self.up_after = up_after
+        self.window = window
+        self.flap_transitions = flap_transitions
+        self.results = []
+        self.status = UNKNOWN
+        self.streak = 0
+        self.flapping = False
+
+    def update(self, up: bool) -> tuple[int, bool]:
+        self.results = (self.results + [up])[-self.window :]
+        if self.status == UNKNOWN:
+            self.status, self.streak = int(up), 0
+        elif int(up) != self.status:
+            self.streak += 1
+            if self.streak >= (self.up_after if up else self.down_after):
+                self.status, self.streak = int(up), 0
+        else:
+            self.streak = 0
+
+        transitions = sum(a != b for a, b in zip(self.results, self.results[1:]))
+        if self.flapping:
+            self.flapping = transitions * 2 >= self.flap_transitions
+        else:
+            self.flapping = transitions >= self.flap_transitions
+        return self.status, self.flapping
+
+
+def test_status_changes_after_consecutive_results():
+    status_filter = StatusFilter(down_after=2, up_after=3, window=20, flap_transitions=6)
+    assert status_filter.status("c") == (UNKNOWN, False)
+
+    assert status_filter.update("c", True) == (1, False)
+    assert status_filter.update("c", False) == (1, False)
+    assert status_filter.update("c", True) == (1, False)
+    assert status_filter.update("c", False) == (1, False)
+    assert status_filter.update("c", False) == (0, False)
+
+    assert status_filter.update("c", True) == (0, False)
+    assert status_filter.update("c", True) == (0, False)
+    assert status_filter.update("c", True) == (1, False)
+
+
+def test_flapping_starts_and_stops_with_hysteresis():
+    status_filter = StatusFilter(down_after=2, up_after=2, window=10, flap_transitions=4)
+    flapping = [status_filter.update("c", bool(i % 2))[1] for i in range(5)]
+    assert flapping == [False, False, False, False, True]
+
+    # Stable results push changes out of window, flapping ends below half of threshold:
+    # window holds 0,1,1... with one change after the 9th one.
+    flapping = [status_filter.update("c", True)[1] for _ in range(10)]
+    assert flapping.index(False) == 8
+    assert not any(flapping[8:])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_update_matches_naive_filter(seed):
+    rng = random.Random(seed)
+    settings = (rng.randint(1, 4), rng.randint(1, 4), rng.randint(2, 62), rng.randint(1, 12))
+    status_filter = StatusFilter(*settings)
+    naive = NaiveFilter(*settings)
+    up_share = rng.random()
+    for _ in range(300):
+        up = rng.random() < up_share
+        assert status_filter.update("c", up) == naive.update(up)
+        assert status_filter.history("c").bit_length() - 1 == len(naive.results)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_restored_filter_continues_like_running_one(seed):
+    rng = random.Random(seed)
+    window = rng.randint(4, 62)
+    settings = (rng.randint(1, 4), rng.randint(1, 4), window, rng.randint(1, 12))
+    running = StatusFilter(*settings)
+    for _ in range(rng.randint(1, 200)):
+        running.update("c", rng.random() < 0.5)
+
+    restored = StatusFilter(*settings)
+    restored.restore("c", *running.status("c"), running.history("c"))
+    assert restored.status("c") == running.status("c")
+    assert restored.history("c") == running.history("c")
+    for _ in range(100):
+        up = rng.random() < 0.5
+        assert restored.update("c", up) == running.update("c", up)
+
+
+def test_restore_without_history_leaves_camera_unknown():
+    status_filter = StatusFilter(2, 2, 20, 6)
+    status_filter.restore("c", 1, False, 1)
+    assert status_filter.status("c") == (UNKNOWN, False)
+    assert len(status_filter) == 0
+
+
+def test_removed_slot_is_reused_from_scratch():
+    status_filter = StatusFilter(2, 2, 20, 6)
+    status_filter.update("a", False)
+    status_filter.remove("a")
+    assert status_filter.status("a") == (UNKNOWN, False)
+
+    assert status_filter.update("b", True) == (1, False)
+    assert status_filter.history("b") == 0b11
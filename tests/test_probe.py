@@ -0,0 +1,22 @@
+import pytest
+
+from probe import parse_probe
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("icmp", ("icmp", None)),
+        (" TCP ", ("tcp", 554)),
+        ("tcp:80", ("tcp", 80)),
+        ("rtsp:8554", ("rtsp", 8554)),
+    ],
+)
+def test_parse_probe(value, expected):
+    assert parse_probe(value) == expected
+
+
+@pytest.mark.parametrize("value", ["ftp", "tcp:abc", "tcp:0", "rtsp:70000", "tcp:-1", 554, None])
+def test_invalid_probe_raises_value_error(value):
+    with pytest.raises(ValueError):
+        parse_probe(value)
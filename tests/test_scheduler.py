@@ -0,0 +1,85 @@
+import pytest
+
+from scheduler import DeadlineScheduler, next_deadline, phase_offset
+
+
+def test_phase_offset_is_stable_and_within_period():
+    for camera_id in ("a", "b", "camera-42"):
+        offset = phase_offset(camera_id, 30)
+        assert 0 <= offset < 30
+        assert offset == phase_offset(camera_id, 30)
+        assert next_deadline(camera_id, 30, 1000.0) >= 1000.0
+        assert (next_deadline(camera_id, 30, 1000.0) - offset) % 30 == pytest.approx(0, abs=1e-6)
+
+
+def test_pop_due_fires_every_period_at_phase_offset():
+    scheduler = DeadlineScheduler()
+    due = next_deadline("a", 10, 1000.0)
+    scheduler.add("a", 10, due)
+
+    assert scheduler.pop_due(due - 1) == []
+    for cycle in range(5):
+        assert scheduler.pop_due(due + cycle * 10) == [("a", due + cycle * 10)]
+        assert scheduler.deadline("a") == pytest.approx(due + (cycle + 1) * 10)
+
+
+def test_pop_due_skips_deadlines_missed_entirely():
+    scheduler = DeadlineScheduler()
+    due = next_deadline("a", 10, 1000.0)
+    scheduler.add("a", 10, due)
+
+    # Dispatcher was late by several periods: camera fires once, next deadline is after now.
+    assert scheduler.pop_due(due + 35) == [("a", due)]
+    assert scheduler.deadline("a") == pytest.approx(due + 40)
+    assert scheduler.pop_due(due + 36) == []
+
+
+def test_explicit_first_deadline_returns_to_phase_offset():
+    scheduler = DeadlineScheduler()
+    scheduler.add("a", 10, 1000.0)
+    assert scheduler.pop_due(1000.0) == [("a", 1000.0)]
+
+    following = scheduler.deadline("a")
+    assert following >= 1000.0 + 10 - scheduler.resolution
+    assert following == pytest.approx(next_deadline("a", 10, following))
+    assert following < 1000.0 + 20
+
+
+def test_cameras_due_within_resolution_fire_together():
+    scheduler = DeadlineScheduler(resolution=0.5)
+    scheduler.add("a", 10, 100.0)
+    scheduler.add("b", 10, 100.4)
+    scheduler.add("c", 10, 101.0)
+    assert sorted(key for key, _ in scheduler.pop_due(100.0)) == ["a", "b"]
+
+
+def test_removed_and_rescheduled_cameras_fire_once():
+    scheduler = DeadlineScheduler()
+    scheduler.add("a", 10, 100.0)
+    scheduler.add("b", 10, 100.0)
+    scheduler.remove("b")
+    # New period replaces pending deadline, the same period keeps it.
+    scheduler.add("a", 20, 105.0)
+    scheduler.add("a", 20, 200.0)
+
+    assert scheduler.pop_due(101.0) == []
+    assert scheduler.pop_due(105.0) == [("a", 105.0)]
+    assert "b" not in scheduler
+    assert len(scheduler) == 1
+
+
+def test_heap_is_compacted_after_many_reschedules():
+    scheduler = DeadlineScheduler()
+    for period in range(1, 3000):
+        scheduler.add("a", period, 100.0 + period)
+    scheduler.pop_due(0.0)
+    assert len(scheduler._heap) <= 2 * len(scheduler) + 1024
+    assert scheduler.next_due() == pytest.approx(100.0 + 2999)
+
+
+@pytest.mark.parametrize("period", [0, -10, -0.5])
+def test_period_must_be_positive(period):
+    scheduler = DeadlineScheduler()
+    with pytest.raises(ValueError):
+        scheduler.add("a", period)
+    assert "a" not in scheduler
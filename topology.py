@@ -0,0 +1,76 @@
+"""
+Here is implemented network topology awareness. Edges (upstream gateways of camera networks, see `edges.csv`)
+are probed before their cameras. While an edge is down, cameras behind it are not probed at all.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+
+def parse_edges(value: str) -> dict[str, str]:
+    """Parse edges setting in "edge=ip,edge=ip" format.
+
+    Args:
+        value (str): Setting value.
+
+    Returns:
+        dict[str, str]: Edge IP by edge name.
+    """
+    edges = {}
+    for item in value.split(","):
+        if "=" in item:
+            edge, ip = item.split("=", 1)
+            edges[edge.strip()] = ip.strip()
+    return edges
+
+
+class EdgeMonitor:
+    """Probes edges periodically and keeps set of edges that are down."""
+
+    def __init__(self, edges: dict[str, str], period: float) -> None:
+        """
+        Args:
+            edges (dict[str, str]): Edge IP by edge name. Only these edges are probed.
+            period (float): Seconds between probes of edges.
+        """
+        self.edges = edges
+        self.period = period
+        self.down = set()
+
+    def is_down(self, edge: str | None) -> bool:
+        return edge in self.down
+
+    async def run(
+        self,
+        probe: Callable[[str], Awaitable[bool]],
+        on_change: Callable[[str, bool], None],
+    ) -> None:
+        """Probe every edge each period.
+
+        Args:
+            probe (Callable[[str], Awaitable[bool]]): Probe of IP, returns True if it answered.
+            on_change (Callable[[str, bool], None]): Called with edge and it's new state when edge goes down or up.
+        """
+        if not self.edges:
+            return
+
+        while True:
+            names = list(self.edges)
+            results = await asyncio.gather(
+                *(probe(self.edges[name]) for name in names), return_exceptions=True
+            )
+            for name, result in zip(names, results):
+                up = result is True
+                if up == (name not in self.down):
+                    continue
+
+                if up:
+                    self.down.discard(name)
+                    logging.info(f"Edge {name} is reachable again")
+                else:
+                    self.down.add(name)
+                    logging.warning(f"Edge {name} is unreachable")
+                on_change(name, up)
+
+            await asyncio.sleep(self.period)
@@ -0,0 +1,108 @@
+"""
+Here are implemented online/offline totals of cameras. Totals are kept as counters, overall and by region,
+edge and group, and updated on every status transition, so they never have to be recounted.
+"""
+
+from registry import CameraRecord
+
+
+# Camera fields totals are broken down by.
+DIMENSIONS = ("region", "edge", "group_name")
+
+
+class StatusTotals:
+    """Total and online cameras counters. Every status change costs O(1)."""
+
+    def __init__(self) -> None:
+        # Status and totals keys by Camera.id.
+        self._cameras = {}
+        # [total, online] by totals key. Key is None for all cameras, (dimension, value) otherwise.
+        self._counts = {}
+        self._changed = set()
+
+    def __len__(self) -> int:
+        return len(self._cameras)
+
+    @staticmethod
+    def _keys(record: CameraRecord) -> tuple:
+        keys = [None]
+        for dimension in DIMENSIONS:
+            value = getattr(record, dimension)
+            if value:
+                keys.append((dimension, value))
+        return tuple(keys)
+
+    def add(self, record: CameraRecord, status: int = 0) -> None:
+        """Count camera. Camera that is already counted keeps it's status.
+
+        Args:
+            record (CameraRecord): Camera.
+            status (int, optional): Status of new camera. Defaults to 0.
+        """
+        current = self._cameras.get(record.id)
+        if current is not None:
+            status = current[0]
+            self.remove(record.id)
+
+        keys = self._keys(record)
+        self._cameras[record.id] = (status, keys)
+        for key in keys:
+            counts = self._counts.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] += status
+            self._changed.add(key)
+
+    def remove(self, camera_id: str) -> None:
+        """Stop counting camera.
+
+        Args:
+            camera_id (str): Camera.id.
+        """
+        current = self._cameras.pop(camera_id, None)
+        if current is None:
+            return
+
+        status, keys = current
+        for key in keys:
+            counts = self._counts[key]
+            counts[0] -= 1
+            counts[1] -= status
+            self._changed.add(key)
+
+    def set(self, camera_id: str, status: int) -> None:
+        """Update counters with camera status. Does nothing if status didn't change.
+
+        Args:
+            camera_id (str): Camera.id.
+            status (int): 1 if camera is online, 0 otherwise.
+        """
+        current = self._cameras.get(camera_id)
+        if current is None or current[0] == status:
+            return
+
+        keys = current[1]
+        self._cameras[camera_id] = (status, keys)
+        for key in keys:
+            self._counts[key][1] += status - current[0]
+            self._changed.add(key)
+
+    def status(self, camera_id: str) -> int | None:
+        current = self._cameras.get(camera_id)
+        return current[0] if current is not None else None
+
+    def counts(self, key: tuple | None = None) -> tuple[int, int]:
+        """Get (total, online) cameras of totals key, all cameras by default."""
+        total, online = self._counts.get(key, (0, 0))
+        return total, online
+
+    def take_changed(self) -> dict:
+        """Get (total, online) of every totals key changed since previous call.
+        Keys left without cameras are reported with zeros once and forgotten.
+        """
+        changed = {}
+        for key in self._changed:
+            changed[key] = self.counts(key)
+            if changed[key][0] == 0 and key is not None:
+                self._counts.pop(key, None)
+        self._changed = set()
+        return changed